@@ -0,0 +1,634 @@
+'''Замеры производительности базы данных заметок
+Запуск: python benchmark.py [количество объектов]'''
+from sys import argv
+from time import perf_counter
+from itertools import accumulate
+import os
+import random
+import tempfile
+
+from database import DataBase
+
+
+def make_database(file: str, objects: int = 100_000, folders: int = 100) -> DataBase:
+    '''Создать базу данных с objects объектами, разложенными по folders папкам'''
+    database = DataBase(file)
+    for i in range(folders):
+        database.add_folder('2024-01-01', f'folder {i}', 'theme', 0)
+    folders_id = [i[-1] for i in database.get_content_folder(0)]
+    for i in range(objects - folders):
+        database.add_note('2024-01-01', f'note {i}', 'theme', folders_id[i % folders])
+    return database
+
+
+def ops_per_second(function, args: list, reconnect: bool = False, database: DataBase = None) -> float:
+    '''Количество вызовов function в секунду
+    reconnect - закрывать соединение после каждого вызова (как до пула соединений)'''
+    start = perf_counter()
+    for arg in args:
+        function(*arg)
+        if reconnect:
+            database.close()
+    return len(args) / (perf_counter() - start)
+
+
+def bench_connections(database: DataBase, calls: int = 2000) -> None:
+    '''Сравнение открытия соединения на каждый вызов и долгоживущего соединения'''
+    folders_id = [i[-1] for i in database.get_content_folder(0)]
+    notes_id = [i[-1] for i in database.info_about_all_notes()[:calls]]
+    methods = {'info_about_note': (database.info_about_note, [(i, ) for i in notes_id]),
+               'get_type_file': (database.get_type_file, [(i, ) for i in notes_id]),
+               'get_parent_file': (database.get_parent_file, [(i, ) for i in notes_id]),
+               'info_about_folder': (database.info_about_folder, [(i, ) for i in folders_id])}
+    print(f'{"метод":<20}{"до, оп/с":>14}{"после, оп/с":>14}')
+    for name, (function, args) in methods.items():
+        before = ops_per_second(function, args, reconnect=True, database=database)
+        after = ops_per_second(function, args)
+        print(f'{name:<20}{before:>14.0f}{after:>14.0f}')
+
+
+def bench_folder_listing(directory: str, sizes: tuple = (1_000, 10_000, 100_000), repeat: int = 5) -> None:
+    '''Время получения содержимого папки с sizes дочерними объектами, целиком и по страницам'''
+    print(f'{"объектов в папке":<20}{"вся папка, мс":>16}{"страница 100, мс":>20}')
+    for size in sizes:
+        with make_database(os.path.join(directory, f'folder_{size}.db'), size + 1, folders=1) as database:
+            folder_id = database.check_main_directory()[0][0]
+            start = perf_counter()
+            for _ in range(repeat):
+                database.get_content_folder(folder_id)
+            full = (perf_counter() - start) / repeat * 1000
+            start = perf_counter()
+            for _ in range(repeat):
+                database.get_content_folder(folder_id, limit=100, offset=size // 2)
+            page = (perf_counter() - start) / repeat * 1000
+            print(f'{size:<20}{full:>16.1f}{page:>20.1f}')
+
+
+def bench_indexes(database: DataBase, calls: int = 200) -> None:
+    '''Сравнение полного просмотра таблицы и поиска по индексу
+    унарный + в условии запрещает SQLite использовать индекс'''
+    notes_id = [i[-1] for i in database.info_about_all_notes()[-calls:]]
+    folders_id = [i[-1] for i in database.get_content_folder(0)]
+    queries = {'notes.id': ('SELECT * FROM notes WHERE {}id = ?', notes_id),
+               'folders.id': ('SELECT * FROM folders WHERE {}id = ?', folders_id),
+               'notes_data.note_id': ('SELECT * FROM notes_data WHERE {}note_id = ?', notes_id),
+               'objects.parent': ('SELECT id FROM objects WHERE {}parent = ?', folders_id)}
+    connection = database.connection
+    print(f'{"столбец":<20}{"скан, оп/с":>14}{"индекс, оп/с":>14}  план')
+    for name, (query, args) in queries.items():
+        result = []
+        for prefix in ('+', ''):
+            start = perf_counter()
+            for arg in args:
+                connection.execute(query.format(prefix), (arg, )).fetchall()
+            result.append(len(args) / (perf_counter() - start))
+        plan = connection.execute('EXPLAIN QUERY PLAN ' + query.format(''), (args[0], )).fetchone()[-1]
+        print(f'{name:<20}{result[0]:>14.0f}{result[1]:>14.0f}  {plan}')
+
+
+def bench_note_save(database: DataBase, elements: int = 500, repeat: int = 5) -> None:
+    '''Время сохранения заметки из elements элементов:
+    по одной строке на вызов (как раньше) и одной пакетной вставкой'''
+    database.add_note('2024-01-01', 'save benchmark', 'theme', 0)
+    note_id = database.check_main_directory()[-1][0]
+    records = [{'type': 'NoteLabel', 'coords': str((i, i)), 'size': '(100, 50)',
+                'content': bytes(f'text {i}', encoding='utf-8'), 'args': '', 'layer': i}
+               for i in range(elements)]
+    start = perf_counter()
+    for _ in range(repeat):
+        database.clear_note_content(note_id)
+        for record in records:
+            database.add_note_content(record['type'], record['coords'], record['size'], record['content'],
+                                      note_id, record['args'])
+    before = (perf_counter() - start) / repeat * 1000
+    start = perf_counter()
+    for _ in range(repeat):
+        database.clear_note_content(note_id)
+        database.add_note_contents(note_id, records)
+    after = (perf_counter() - start) / repeat * 1000
+    print(f'сохранение заметки из {elements} элементов: до {before:.1f} мс, после {after:.1f} мс')
+
+
+def bench_search(database: DataBase, repeat: int = 20, words: int = 20_000) -> None:
+    '''Время поиска по тексту заметок: перебор notes_data через LIKE (как без индекса) и FTS5
+    в каждую заметку добавляется текст, у части заметок - код и текстовый или двоичный файл'''
+    random.seed(0)
+    vocabulary = [f'w{i}' for i in range(words)]
+    # частоты слов по закону Ципфа, как в обычном тексте
+    weights = list(accumulate(1 / (i + 1) for i in range(words)))
+    notes_id = [i[-1] for i in database.info_about_all_notes()]
+    start = perf_counter()
+    with database.connection as connection:
+        cursor = connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        for i, note_id in enumerate(notes_id):
+            text = ' '.join(random.choices(vocabulary, cum_weights=weights, k=40))
+            records = [{'type': 'NoteLabel', 'content': bytes(text, encoding='utf-8')}]
+            if i % 3 == 0:
+                records.append({'type': 'CodeLabel', 'content': bytes(f'def f{i}(x):\n    return x + {i}',
+                                                                      encoding='utf-8')})
+            if i % 10 == 0:
+                records.append({'type': 'File', 'content': bytes(f'{text}\nfile {i}', encoding='utf-8')})
+            if i % 50 == 0:
+                records.append({'type': 'File', 'content': bytes([0, 1, 2, 255]) * 256})
+            for layer, record in enumerate(records):
+                record.update({'coords': '(0, 0)', 'size': '(100, 50)', 'args': '', 'layer': layer})
+            DataBase._insert_note_contents(cursor, note_id, records)
+        cursor.close()
+    indexed = database.connection.execute('SELECT COUNT(*) FROM notes_search').fetchone()[0]
+    print(f'текст {len(notes_id)} заметок, {indexed} элементов в индексе: {perf_counter() - start:.1f} с')
+    queries = {'редкое слово': f'w{words - 1}',
+               'частое слово': 'w0',
+               'среднее слово': 'w50',
+               'два слова': 'w1 w2',
+               'префикс': 'w12',
+               'код': 'def f999'}
+    connection = database.connection
+    print(f'{"запрос":<16}{"LIKE, мс":>12}{"FTS5, мс":>12}{"найдено":>10}{"совпадений":>12}')
+    for name, text in queries.items():
+        like = '%' + text.split()[0] + '%'
+        start = perf_counter()
+        for _ in range(repeat):
+            connection.execute('SELECT note_id FROM notes_data WHERE note_data_type IN (?, ?) '
+                               'AND CAST(note_data_content AS TEXT) LIKE ?',
+                               ('NoteLabel', 'CodeLabel', like)).fetchall()
+        before = (perf_counter() - start) / repeat * 1000
+        start = perf_counter()
+        for _ in range(repeat):
+            found = database.search(text)
+        after = (perf_counter() - start) / repeat * 1000
+        print(f'{name:<16}{before:>12.1f}{after:>12.1f}{len(found):>10}{database.count_matches(text):>12}')
+
+
+def bench_stroke_latency(events: int = 2000) -> None:
+    '''Количество событий рисования в секунду с перерисовкой холста
+    события мыши воспроизводятся без экрана (платформа offscreen)'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import Qt, QPointF, QEvent
+    from PyQt6.QtGui import QMouseEvent
+    from note_editor1 import Canvas
+
+    app = QApplication.instance() or QApplication(argv)
+    main_canvas = Canvas()
+    main_canvas.show()
+    canvas = main_canvas.paint_canvas
+    canvas.set_drawing_mode(True)
+    app.processEvents()
+    for full_update in (True, False):
+        start = perf_counter()
+        for i in range(events):
+            position = QPointF(100 + i % 1800, 100 + (i * 7) % 800)
+            canvas.mouseMoveEvent(QMouseEvent(QEvent.Type.MouseMove, position, position, Qt.MouseButton.LeftButton,
+                                              Qt.MouseButton.LeftButton, Qt.KeyboardModifier.NoModifier))
+            if full_update:
+                # перерисовка всего холста, как при setPixmap на каждое событие
+                canvas.update()
+            app.processEvents()
+        canvas.finish_stroke()
+        name = 'весь холст' if full_update else 'изменённая область'
+        print(f'рисование, перерисовка {name}: {events / (perf_counter() - start):.0f} событий/с')
+
+
+def bench_hit_testing(elements: int = 5000, clicks: int = 2000) -> None:
+    '''Количество поисков элемента под курсором в секунду на холсте из elements элементов:
+    перебором всех элементов (как раньше) и по сетке'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import QPoint
+    from note_editor1 import Canvas, File
+
+    app = QApplication.instance() or QApplication(argv)
+    canvas = Canvas()
+    canvas.resize(20_000, 20_000)
+    for i in range(elements):
+        # элементы добавляются без do_layout, чтобы не замерять его
+        element = File(QPoint(i * 37 % 19_900, i * 101 % 19_900), canvas, file=f'file {i}')
+        canvas.layout.append(element)
+        canvas.track_element(element)
+    app.processEvents()
+    points = [QPoint(i * 53 % 20_000, i * 97 % 20_000) for i in range(clicks)]
+    start = perf_counter()
+    for point in points:
+        [k for k in canvas.layout if k != canvas.paint_canvas and point in canvas.items[k]()]
+    before = clicks / (perf_counter() - start)
+    start = perf_counter()
+    for point in points:
+        found = canvas.grid.at(point)
+        if len(found) > 1:
+            found.sort(key=canvas.layout.index)
+    after = clicks / (perf_counter() - start)
+    print(f'поиск элемента под курсором среди {elements}: до {before:.0f} оп/с, после {after:.0f} оп/с')
+
+
+def bench_widget_operations(elements: int = 5000) -> None:
+    '''Количество операций с виджетами и время одного действия пользователя на холсте из elements элементов
+    раньше каждое действие вызывало disable, show и raise_ для всех элементов'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import Qt, QPoint, QPointF, QEvent
+    from PyQt6.QtGui import QMouseEvent
+    from note_editor1 import Canvas
+
+    app = QApplication.instance() or QApplication(argv)
+    canvas = Canvas()
+    canvas.resize(20_000, 20_000)
+    start = perf_counter()
+    for i in range(elements):
+        canvas.add_file(QPoint(i * 37 % 19_900, i * 101 % 19_900), file=f'file {i}')
+    print(f'добавление {elements} элементов: {perf_counter() - start:.1f} с')
+    element = canvas.layout[elements // 2]
+    position = QPointF(element.geometry().center())
+    click = QMouseEvent(QEvent.Type.MouseButtonRelease, position, position, Qt.MouseButton.LeftButton,
+                        Qt.MouseButton.LeftButton, Qt.KeyboardModifier.NoModifier)
+    actions = {'добавление': lambda: canvas.add_file(QPoint(10, 10), file='file'),
+               'выбор элемента': lambda: canvas.mouseReleaseEvent(click),
+               'сдвинуть назад': lambda: canvas.move_element_back(element),
+               'сдвинуть вперёд': lambda: canvas.move_element_forward(element),
+               'Esc': canvas.do_layout,
+               'удаление': lambda: canvas.delete_element(canvas.layout[-1]),
+               'отмена': canvas.undo}
+    print(f'{"действие":<20}{"операций до":>14}{"операций после":>16}{"время, мс":>12}')
+    for name, action in actions.items():
+        canvas.widget_operations.clear()
+        start = perf_counter()
+        action()
+        spent = (perf_counter() - start) * 1000
+        app.processEvents()
+        print(f'{name:<20}{3 * len(canvas.layout):>14}{sum(canvas.widget_operations.values()):>16}{spent:>12.2f}')
+
+
+def bench_note_open(directory: str, elements: int = 3000) -> None:
+    '''Время открытия заметки из elements текстовых полей на холсте 20000 x 20000 и количество виджетов:
+    все элементы сразу (как раньше) и только видимые'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    from note_editor1 import NoteEditor, Canvas
+
+    app = QApplication.instance() or QApplication(argv)
+    with DataBase(os.path.join(directory, 'open.db')) as database:
+        database.add_note('2024-01-01', 'open benchmark', 'theme', 0)
+        note_id = database.check_main_directory()[-1][0]
+        canvas = Canvas()
+        canvas.set_args(size='(20000, 20000)')
+        info = canvas.paint_canvas.info()
+        records = [{'type': 'PaintCanvas', 'coords': str(info['coords']), 'size': str(info['size']),
+                    'content': info['content'], 'args': info['args'], 'layer': 0}]
+        records += [{'type': 'CodeLabel' if i % 2 else 'NoteLabel', 'coords': str((i * 37 % 19_800, i * 101 % 19_800)),
+                     'size': '(120, 60)', 'content': bytes(f'text {i}', encoding='utf-8'), 'args': '', 'layer': i + 1}
+                    for i in range(elements)]
+        database.add_note_contents(note_id, records)
+
+        class Viewer:
+            pass
+        viewer = Viewer()
+        viewer.database = database
+        for virtual in (False, True):
+            start = perf_counter()
+            editor = NoteEditor(viewer, note_id=note_id)
+            editor.load_note(database.get_note_layout(note_id))
+            if virtual:
+                editor.show()
+                app.processEvents()
+            else:
+                editor.canvas.update_viewport(editor.canvas.rect())
+            spent = perf_counter() - start
+            widgets = len(editor.canvas.items)
+            name = 'только видимые' if virtual else 'все элементы'
+            print(f'открытие заметки из {elements} элементов, {name}: {spent * 1000:.0f} мс, виджетов {widgets}')
+            editor.close()
+
+
+def bench_background_loading(directory: str, images: int = 10, texts: int = 50, hidden: int = 30) -> None:
+    '''Открытие заметки с images картинками 2000 x 2000 в видимой области, hidden картинками за её пределами
+    и texts текстовыми полями: самая долгая остановка интерфейса и время до показа текста
+    при загрузке в главном потоке (как раньше) и в фоне'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import QBuffer, QByteArray, QIODevice, QThreadPool
+    from PyQt6.QtGui import QImage, QColor
+    from note_editor1 import NoteEditor, Canvas
+
+    app = QApplication.instance() or QApplication(argv)
+    with DataBase(os.path.join(directory, 'background.db')) as database:
+        database.add_note('2024-01-01', 'background benchmark', 'theme', 0)
+        note_id = database.check_main_directory()[-1][0]
+        info = Canvas().paint_canvas.info()
+        records = [{'type': 'PaintCanvas', 'coords': str(info['coords']), 'size': str(info['size']),
+                    'content': info['content'], 'args': info['args'], 'layer': 0}]
+        image = QImage(2000, 2000, QImage.Format.Format_RGB32)
+        for i in range(images + hidden):
+            image.fill(QColor(i * 5, 0, 0))
+            data = QByteArray()
+            buffer = QBuffer(data)
+            buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+            image.save(buffer, 'PNG')
+            coords = (i * 60, 300) if i < images else (1600 + i % 6 * 60, 300 + i // 6 * 60)
+            records.append({'type': 'ImageLabel', 'coords': str(coords), 'size': '(50, 50)',
+                            'content': data.data(), 'args': '', 'layer': len(records)})
+        records += [{'type': 'NoteLabel', 'coords': str((i * 10, i * 10)), 'size': '(100, 50)',
+                     'content': bytes(f'text {i}', encoding='utf-8'), 'args': '', 'layer': len(records) + i}
+                    for i in range(texts)]
+        database.add_note_contents(note_id, records)
+
+        class Viewer:
+            pass
+        viewer = Viewer()
+        viewer.database = database
+        for background in (False, True):
+            editor = NoteEditor(viewer, note_id=note_id)
+            editor.show()
+            app.processEvents()
+            start = last = perf_counter()
+            longest = 0
+            if background:
+                editor.load_note_in_background(database, note_id)
+            else:
+                editor.load_note(database.get_note_layout(note_id))
+            text_shown = None
+            while True:
+                app.processEvents()
+                now = perf_counter()
+                longest = max(longest, now - last)
+                last = now
+                if text_shown is None and any(k.type_name() == 'NoteLabel' for k in editor.canvas.items):
+                    text_shown = now - start
+                labels = [k for k in editor.canvas.items if k.type_name() == 'ImageLabel']
+                if labels and all(not k.label.pixmap().isNull() for k in labels) and \
+                   not editor.canvas.paint_canvas.loading and QThreadPool.globalInstance().activeThreadCount() == 0:
+                    break
+            name = 'в фоне' if background else 'в главном потоке'
+            print(f'загрузка {name}: текст через {text_shown * 1000:.0f} мс, всё через {(now - start) * 1000:.0f} мс, '
+                  f'самая долгая остановка интерфейса {longest * 1000:.0f} мс, картинок показано {len(labels)}')
+            editor.close()
+
+
+def bench_image_fetch(directory: str, delay: float = 0.5) -> None:
+    '''Остановка интерфейса при перетаскивании картинки по ссылке с локального сервера, отвечающего за delay секунд:
+    загрузка urlopen в главном потоке (как раньше), загрузка в фоне и повторная загрузка из кэша'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.request import urlopen
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import QPoint, QUrl, QBuffer, QByteArray, QIODevice
+    from PyQt6.QtGui import QImage, QColor
+    import note_editor1
+
+    app = QApplication.instance() or QApplication(argv)
+    image = QImage(1000, 1000, QImage.Format.Format_RGB32)
+    image.fill(QColor('green'))
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    image.save(buffer, 'PNG')
+    png = data.data()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            sleep_until = perf_counter() + delay
+            while perf_counter() < sleep_until:
+                pass
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Cache-Control', 'max-age=3600')
+            self.send_header('Content-Length', str(len(png)))
+            self.end_headers()
+            self.wfile.write(png)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/image.png'
+    start = perf_counter()
+    urlopen(url).read()
+    print(f'картинка по ссылке, загрузка в главном потоке: интерфейс остановлен на {(perf_counter() - start) * 1000:.0f} мс')
+    note_editor1.FETCH_CACHE = os.path.join(directory, 'http_cache')
+    canvas = note_editor1.Canvas()
+    for name in ('загрузка в фоне', 'повторно из кэша'):
+        start = perf_counter()
+        canvas.add_remote_image(QPoint(10, 10), QUrl(url))
+        blocked = perf_counter() - start
+        while canvas.fetcher.replies:
+            app.processEvents()
+        print(f'картинка по ссылке, {name}: интерфейс остановлен на {blocked * 1000:.0f} мс, '
+              f'картинка через {(perf_counter() - start) * 1000:.0f} мс')
+    server.shutdown()
+
+
+def bench_highlighting(lines: int = 50_000) -> None:
+    '''Время подсветки Python-кода из lines строк в QTextDocument:
+    отдельный проход re.finditer на каждое правило (как раньше) и одно общее выражение'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import re
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtGui import QSyntaxHighlighter, QTextDocument
+    import highlighter
+    from highlighter import CodeSyntaxHighlighter, text_format, keywords
+
+    # правила подсветки до общего выражения
+    syntax_formats = {r'\b' + word + r'\b': text_format(fc='dark orange') for word in keywords}
+    syntax_formats.update({r'#+.*': text_format(fc='red'),
+                           r"'.*?'": text_format(fc='green'),
+                           r'".*?"': text_format(fc='green'),
+                           r'\b((?<=class)|(?<=def)).*?(?=:|\()': text_format(fc='blue')})
+
+    class OldHighlighter(QSyntaxHighlighter):
+        def highlightBlock(self, text):
+            for pattern, format in syntax_formats.items():
+                for match_ in re.finditer(pattern, text):
+                    start, end = match_.span()
+                    self.setFormat(start, end - start, format)
+
+    app = QApplication.instance() or QApplication(argv)
+    sample = ['class Point(object):  # точка на холсте',
+              '    def move(self, x, y):',
+              "        if x is None or y is None:",
+              "            return 'not moved'",
+              '        for i in range(10):',
+              '            self.x, self.y = x + i, y - i',
+              '        return True',
+              '']
+    text = '\n'.join(sample[i % len(sample)] for i in range(lines))
+    # вся подсветка сразу, без откладывания строк на потом
+    budget, highlighter.FRAME_BUDGET = highlighter.FRAME_BUDGET, float('inf')
+    print(f'{"подсветка":<16}{"всего, мс":>12}{"на блок, мкс":>14}')
+    for name, highlighter_class in (('до', OldHighlighter), ('после', CodeSyntaxHighlighter)):
+        document = QTextDocument()
+        document.setPlainText(text)
+        syntax_highlighter = highlighter_class(document)
+        start = perf_counter()
+        syntax_highlighter.rehighlight()
+        spent = perf_counter() - start
+        print(f'{name:<16}{spent * 1000:>12.0f}{spent / lines * 1e6:>14.1f}')
+    highlighter.FRAME_BUDGET = budget
+
+
+def bench_languages(lines: int = 20_000) -> None:
+    '''Скорость подсветки lines строк кода на каждом языке в QTextDocument
+    и время первого разбора, в которое входит сборка регулярного выражения языка'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import re
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtGui import QTextDocument
+    import highlighter
+    from highlighter import CodeSyntaxHighlighter, languages
+
+    app = QApplication.instance() or QApplication(argv)
+    samples = {'Python': ['def move(self, x=0, y=1.5):  # сдвиг', "    return 'moved' if x else None"],
+               'SQL': ["SELECT id, name FROM notes WHERE theme = 'work' -- темы",
+                       'ORDER BY date DESC LIMIT 100 OFFSET 20;'],
+               'JavaScript': ['function move(x, y) { // сдвиг', '    return `moved ${x}` || null; /* конец */ }'],
+               'C': ['#include <stdio.h>', 'int main(void) { printf("%d", 42); return 0; } // конец'],
+               'Bash': ['for file in $HOME/*.txt; do  # файлы', '    echo "${file}" && exit 0; done'],
+               'JSON': ['{"name": "note", "size": [1920, 1080],', ' "visible": true, "parent": null}']}
+    budget, highlighter.FRAME_BUDGET = highlighter.FRAME_BUDGET, float('inf')
+    print(f'{"язык":<16}{"строк/с":>12}{"первый разбор, мкс":>20}')
+    for name, sample in samples.items():
+        language = languages[name]
+        language.regex = None
+        re.purge()
+        start = perf_counter()
+        list(language.tokens(sample[0]))
+        first = perf_counter() - start
+        document = QTextDocument()
+        document.setPlainText('\n'.join(sample[i % len(sample)] for i in range(lines)))
+        syntax_highlighter = CodeSyntaxHighlighter(document, language=name)
+        start = perf_counter()
+        syntax_highlighter.rehighlight()
+        spent = perf_counter() - start
+        print(f'{name:<16}{lines / spent:>12.0f}{first * 1e6:>20.0f}')
+    highlighter.FRAME_BUDGET = budget
+
+
+def bench_block_code_rehighlight(repeat: int = 200) -> None:
+    '''Количество строк, подсвечиваемых заново после нажатия клавиши в тексте заметки с блоками ```:
+    при наборе в конце каждой строки текста и кода и при открытии нового блока в начале'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication, QTextEdit
+    from highlighter import PythonSyntaxHighlighterInBlockCode
+
+    class CountingHighlighter(PythonSyntaxHighlighterInBlockCode):
+        blocks = 0
+
+        def highlightBlock(self, text):
+            self.blocks += 1
+            super().highlightBlock(text)
+
+    app = QApplication.instance() or QApplication(argv)
+    sample = ['Заметка про `x = None` и код:',
+              '```python',
+              'def move(self, x):',
+              '    """Сдвинуть точку',
+              '    if x: return',
+              '    """',
+              "    return 'moved'  # ok",
+              '```',
+              'текст ```y if z``` текст',
+              '']
+    edit = QTextEdit()
+    edit.setPlainText('\n'.join(sample * repeat))
+    document = edit.document()
+    highlighter = CountingHighlighter(document)
+    app.processEvents()
+    typed = []
+    for i in range(len(sample)):
+        cursor = edit.textCursor()
+        block = document.findBlockByNumber(len(sample) * repeat // 2 + i)
+        cursor.setPosition(block.position() + block.length() - 1)
+        highlighter.blocks = 0
+        cursor.insertText('a')
+        app.processEvents()
+        typed.append(highlighter.blocks)
+    cursor = edit.textCursor()
+    cursor.setPosition(0)
+    highlighter.blocks = 0
+    cursor.insertText('```\n')
+    app.processEvents()
+    print(f'подсветка заново после нажатия клавиши, строк из {document.blockCount()}: '
+          f'набор текста в среднем {sum(typed) / len(typed):.1f}, максимум {max(typed)}, '
+          f'новый ``` в начале {highlighter.blocks}')
+
+
+def bench_large_code(lines: int = 50_000, settle: float = 5) -> None:
+    '''Вставка кода из lines строк в CodeLabel: время до возврата в цикл событий, кадры за settle секунд
+    после вставки и время до полной подсветки, подсветка целиком сразу (как раньше) и частями по таймеру'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import QPoint, QTimer
+    from note_editor1 import Canvas
+    import highlighter
+
+    app = QApplication.instance() or QApplication(argv)
+    sample = ['class Point(object):  # точка на холсте',
+              '    def move(self, x, y):',
+              "        if x is None or y is None:",
+              "            return 'not moved'",
+              '']
+    text = '\n'.join(sample[i % len(sample)] for i in range(lines))
+    budget = highlighter.FRAME_BUDGET
+    print(f'{"подсветка":<16}{"вставка, мс":>14}{"макс. кадр после, мс":>22}{"вся подсветка, мс":>20}')
+    for name, highlighter.FRAME_BUDGET in (('целиком', float('inf')), ('частями', budget)):
+        canvas = Canvas()
+        canvas.resize(2000, 2000)
+        canvas.show()
+        app.processEvents()
+        frames = []
+        last = perf_counter()
+
+        def frame():
+            nonlocal last
+            frames.append(perf_counter() - last)
+            last = perf_counter()
+
+        timer = QTimer()
+        timer.setInterval(0)
+        timer.timeout.connect(frame)
+        start = perf_counter()
+        canvas.add_code(QPoint(10, 10), text=text)
+        pasted = perf_counter() - start
+        last = perf_counter()
+        timer.start()
+        code = canvas.layout[-1]
+        # цикл событий крутится одинаковое время, чтобы в оба замера попала и фоновая разметка QTextEdit
+        highlighted = None
+        while highlighted is None or perf_counter() - start < settle:
+            app.processEvents()
+            if highlighted is None and not code.highlighter.timer.isActive():
+                highlighted = perf_counter() - start
+        timer.stop()
+        print(f'{name:<16}{pasted * 1000:>14.0f}{max(frames) * 1000:>22.0f}{highlighted * 1000:>20.0f}')
+    highlighter.FRAME_BUDGET = budget
+
+
+def main():
+    objects = int(argv[1]) if len(argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, 'benchmark.db')
+        start = perf_counter()
+        with make_database(file, objects) as database:
+            print(f'создание базы из {objects} объектов: {perf_counter() - start:.1f} с')
+            bench_connections(database)
+            bench_indexes(database)
+            bench_note_save(database)
+            bench_search(database)
+        start = perf_counter()
+        DataBase(file).close()
+        print(f'открытие и проверка версии схемы: {(perf_counter() - start) * 1000:.1f} мс')
+        bench_folder_listing(directory)
+        bench_note_open(directory)
+        bench_background_loading(directory)
+        bench_image_fetch(directory)
+    bench_stroke_latency()
+    bench_hit_testing()
+    bench_widget_operations()
+    bench_highlighting()
+    bench_languages()
+    bench_block_code_rehighlight()
+    bench_large_code()
+
+
+if __name__ == '__main__':
+    main()
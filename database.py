@@ -1,4 +1,214 @@
 import sqlite3 as sq
+import threading
+import hashlib
+from sys import argv
+
+
+# типы элементов заметки, содержимое которых хранится в blobs
+BLOB_TYPES = ('ImageLabel', 'File')
+# типы элементов заметки, текст которых попадает в полнотекстовый поиск
+SEARCH_TYPES = ('NoteLabel', 'CodeLabel', 'File')
+# файлы больше этого размера не индексируются
+SEARCH_MAX_SIZE = 4 * 1024 * 1024
+# сколько совпадений ранжируется при поиске, если совпадений больше - ранжируются последние
+SEARCH_CANDIDATES = 10000
+
+
+def store_blob(cursor: sq.Cursor, type: str, content) -> tuple:
+    '''Сохранить содержимое картинки или файла в blobs по хэшу
+    Возвращает (note_data_content, note_data_blob) для записи в notes_data'''
+    if type not in BLOB_TYPES or not isinstance(content, bytes):
+        return content, None
+    blob_hash = hashlib.sha256(content).hexdigest()
+    # refcount увеличивают триггеры notes_data
+    cursor.execute('INSERT OR IGNORE INTO blobs (hash, content, refcount) VALUES (?, ?, 0)', (blob_hash, content))
+    return None, blob_hash
+
+
+def search_text(type: str, content) -> str | None:
+    '''Текст элемента заметки для поискового индекса
+    None - элемент не индексируется: не текстовый тип, слишком большой или не UTF-8 файл'''
+    if type not in SEARCH_TYPES or content is None:
+        return None
+    if isinstance(content, str):
+        return content
+    if len(content) > SEARCH_MAX_SIZE or (type == 'File' and b'\0' in content):
+        return None
+    try:
+        return bytes(content).decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def index_contents(cursor: sq.Cursor, rows) -> None:
+    '''Добавить элементы в поисковый индекс, rows - (note_data_id, note_id, type, content)
+    прежний текст элементов удаляется из индекса'''
+    rows = list(rows)
+    cursor.executemany('DELETE FROM notes_search WHERE rowid = ?', [(row[0], ) for row in rows])
+    cursor.executemany('INSERT INTO notes_search (rowid, content, note_id) VALUES (?, ?, ?)',
+                       [(data_id, text, note_id) for data_id, note_id, type, content in rows
+                        if (text := search_text(type, content)) is not None])
+
+
+def search_query(text: str) -> str:
+    '''Запрос FTS5 из введённого текста: все слова обязательны, последнее слово - префикс
+    слова берутся в кавычки, чтобы символы синтаксиса FTS5 не вызывали ошибок'''
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+
+def migration_objects_position(cursor: sq.Cursor) -> None:
+    '''Перенести содержимое папок из folders.content и main_directory в objects.parent и objects.position'''
+    columns = [i[1] for i in cursor.execute('PRAGMA table_info(objects)')]
+    if 'position' in columns:
+        return
+    cursor.execute('ALTER TABLE objects ADD COLUMN position INTEGER NOT NULL DEFAULT 0')
+    for folder_id, content in cursor.execute('SELECT id, content FROM folders').fetchall():
+        cursor.executemany('UPDATE objects SET parent = ?, position = ? WHERE id = ?',
+                           [(folder_id, position, int(id_obj)) for position, id_obj in enumerate(content.split())])
+    root = cursor.execute('SELECT id_obj FROM main_directory ORDER BY rowid').fetchall()
+    cursor.executemany('UPDATE objects SET parent = 0, position = ? WHERE id = ?',
+                       [(position, id_obj) for position, (id_obj, ) in enumerate(root)])
+    cursor.execute("UPDATE folders SET content = ''")
+    cursor.execute('DELETE FROM main_directory')
+
+
+def migration_indexes(cursor: sq.Cursor) -> None:
+    '''Индексы для поиска содержимого папок и заметок'''
+    # дочерние объекты папки в порядке добавления
+    cursor.execute('CREATE INDEX IF NOT EXISTS objects_parent_position ON objects (parent, position)')
+    # элементы заметки
+    cursor.execute('CREATE INDEX IF NOT EXISTS notes_data_note_id ON notes_data (note_id)')
+
+
+def migration_primary_keys(cursor: sq.Cursor) -> None:
+    '''Сделать id первичным ключом notes и folders, порядок столбцов не меняется'''
+    cursor.execute('''
+    CREATE TABLE notes_new (
+        date TEXT NOT NULL,
+        theme TEXT,
+        name TEXT NOT NULL,
+        id INTEGER PRIMARY KEY REFERENCES objects(id)
+        )''')
+    cursor.execute('INSERT INTO notes_new (date, theme, name, id) SELECT date, theme, name, id FROM notes')
+    cursor.execute('DROP TABLE notes')
+    cursor.execute('ALTER TABLE notes_new RENAME TO notes')
+
+    cursor.execute('''
+    CREATE TABLE folders_new (
+        id INTEGER PRIMARY KEY REFERENCES objects(id),
+        name TEXT NOT NULL,
+        date TEXT NOT NULL,
+        theme TEXT,
+        content TEXT NOT NULL
+        )''')
+    cursor.execute('INSERT INTO folders_new (id, name, date, theme, content) '
+                   'SELECT id, name, date, theme, content FROM folders')
+    cursor.execute('DROP TABLE folders')
+    cursor.execute('ALTER TABLE folders_new RENAME TO folders')
+
+
+def migration_notes_data_layer(cursor: sq.Cursor) -> None:
+    '''Слой элемента заметки: порядок отображения не зависит от note_data_id'''
+    cursor.execute('ALTER TABLE notes_data ADD COLUMN note_data_layer INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+    UPDATE notes_data SET note_data_layer = (
+        SELECT COUNT(*) FROM notes_data AS previous
+        WHERE previous.note_id = notes_data.note_id AND previous.note_data_id < notes_data.note_data_id)''')
+
+
+def migration_blobs(cursor: sq.Cursor) -> None:
+    '''Хранилище картинок и файлов по хэшу содержимого с подсчётом ссылок'''
+    cursor.execute('''
+    CREATE TABLE blobs (
+        hash TEXT PRIMARY KEY,
+        content BLOB NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0
+        )''')
+    cursor.execute('ALTER TABLE notes_data ADD COLUMN note_data_blob TEXT REFERENCES blobs(hash)')
+    cursor.execute('''
+    CREATE TRIGGER notes_data_blob_insert AFTER INSERT ON notes_data WHEN NEW.note_data_blob IS NOT NULL
+    BEGIN
+        UPDATE blobs SET refcount = refcount + 1 WHERE hash = NEW.note_data_blob;
+    END''')
+    cursor.execute('''
+    CREATE TRIGGER notes_data_blob_delete AFTER DELETE ON notes_data WHEN OLD.note_data_blob IS NOT NULL
+    BEGIN
+        UPDATE blobs SET refcount = refcount - 1 WHERE hash = OLD.note_data_blob;
+        DELETE FROM blobs WHERE hash = OLD.note_data_blob AND refcount <= 0;
+    END''')
+    cursor.execute('''
+    CREATE TRIGGER notes_data_blob_update AFTER UPDATE OF note_data_blob ON notes_data
+    WHEN OLD.note_data_blob IS NOT NEW.note_data_blob
+    BEGIN
+        UPDATE blobs SET refcount = refcount + 1 WHERE hash = NEW.note_data_blob;
+        UPDATE blobs SET refcount = refcount - 1 WHERE hash = OLD.note_data_blob;
+        DELETE FROM blobs WHERE hash = OLD.note_data_blob AND refcount <= 0;
+    END''')
+    rows = cursor.execute('SELECT note_data_id, note_data_type, note_data_content FROM notes_data '
+                          f"WHERE note_data_type IN ({', '.join('?' * len(BLOB_TYPES))})", BLOB_TYPES).fetchall()
+    for data_id, type, content in rows:
+        content, blob_hash = store_blob(cursor, type, content)
+        if blob_hash is not None:
+            cursor.execute('UPDATE notes_data SET note_data_content = NULL, note_data_blob = ? WHERE note_data_id = ?',
+                           (blob_hash, data_id))
+
+
+def migration_search(cursor: sq.Cursor) -> None:
+    '''Полнотекстовый поиск по тексту, коду и текстовым файлам заметок
+    rowid индекса - note_data_id элемента'''
+    cursor.execute('''
+    CREATE VIRTUAL TABLE notes_search USING fts5(
+        content,
+        note_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+        )''')
+    cursor.execute('''
+    CREATE TRIGGER notes_data_search_delete AFTER DELETE ON notes_data
+    BEGIN
+        DELETE FROM notes_search WHERE rowid = OLD.note_data_id;
+    END''')
+    index_contents(cursor, cursor.execute(f'''
+    SELECT note_data_id, note_id, note_data_type, COALESCE(note_data_content, blobs.content)
+    FROM notes_data LEFT JOIN blobs ON blobs.hash = notes_data.note_data_blob
+    WHERE note_data_type IN ({', '.join('?' * len(SEARCH_TYPES))})''', SEARCH_TYPES).fetchall())
+
+
+# миграции схемы по порядку, номер версии - номер миграции начиная с 1
+MIGRATIONS = [migration_objects_position,
+              migration_indexes,
+              migration_primary_keys,
+              migration_notes_data_layer,
+              migration_blobs,
+              migration_search]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class LazyBlob:
+    """Отложенная загрузка содержимого из blobs
+    содержимое читается из базы данных только при обращении"""
+    def __init__(self, database, blob_hash: str, size: int) -> None:
+        self.database = database
+        self.hash = blob_hash
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def chunks(self, chunk_size: int = 1024 * 1024):
+        """Читать содержимое частями по chunk_size байт"""
+        connection = self.database.connection
+        rowid = connection.execute('SELECT rowid FROM blobs WHERE hash = ?', (self.hash, )).fetchone()[0]
+        with connection.blobopen('blobs', 'content', rowid, readonly=True) as blob:
+            while chunk := blob.read(chunk_size):
+                yield chunk
+
+    def read(self) -> bytes:
+        """Прочитать содержимое целиком"""
+        return b''.join(self.chunks())
 
 
 class DataBase:
@@ -6,14 +216,24 @@ class DataBase:
         Создание класса для управления базы данных заметок
         file - название базы данных в .bd формате"""
     
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, journal_mode: str = 'WAL', synchronous: str = 'NORMAL',
+                 cache_size: int = -16000, mmap_size: int = 64 * 1024 * 1024) -> None:
         """Создание класса для управления базы данных заметок
-        file - название базы данных в .db формате"""
-        self.file = file        
-        with sq.connect(file) as connection:
+        file - название базы данных в .db формате
+        journal_mode, synchronous, cache_size, mmap_size - значения PRAGMA для соединений"""
+        self.file = file
+        self.pragmas = {'journal_mode': journal_mode,
+                        'synchronous': synchronous,
+                        'cache_size': cache_size,
+                        'mmap_size': mmap_size}
+        # одно соединение на поток
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        # кэш папок для построения пути: id -> (имя, родитель)
+        self._folders_cache = {}
+        with self.connection as connection:
             cursor = connection.cursor()
-            # включить внешние ключи
-            connection.execute('PRAGMA foreign_keys = ON;')
 
             # все объекты
             objects = '''
@@ -64,212 +284,386 @@ class DataBase:
             id_obj INTEGER REFERENCES objects(id)
             )'''
             cursor.execute(main_directory)
+
+            # версия схемы
+            cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+            if cursor.execute('SELECT version FROM schema_version').fetchone() is None:
+                cursor.execute('INSERT INTO schema_version (version) VALUES (0)')
             
             connection.commit()
             cursor.close()
-        connection.close()
+        self.migrate()
+
+    @property
+    def schema_version(self) -> int:
+        """Текущая версия схемы базы данных"""
+        return self.connection.execute('SELECT version FROM schema_version').fetchone()[0]
+
+    def migrate(self) -> None:
+        """Обновить схему базы данных до SCHEMA_VERSION"""
+        version = self.schema_version
+        if version > SCHEMA_VERSION:
+            raise sq.DatabaseError(f'Версия базы данных {version} новее поддерживаемой {SCHEMA_VERSION}')
+        connection = self.connection
+        for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            with connection:
+                cursor = connection.cursor()
+                cursor.execute('BEGIN')
+                migration(cursor)
+                cursor.execute('UPDATE schema_version SET version = (?)', (version, ))
+                cursor.close()
+
+    @staticmethod
+    def _next_position(cursor: sq.Cursor, directory_id: int) -> int:
+        '''Позиция для нового объекта в конце папки directory_id'''
+        return cursor.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM objects WHERE parent = ?',
+                              (directory_id, )).fetchone()[0]
+
+    @property
+    def connection(self) -> sq.Connection:
+        """Соединение с базой данных для текущего потока"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sq.connect(self.file, check_same_thread=False)
+            for pragma, value in self.pragmas.items():
+                if value is not None:
+                    connection.execute(f'PRAGMA {pragma} = {value};')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self) -> None:
+        """Закрыть все соединения с базой данных"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def info_about_all_notes(self) -> list:
         """Получить информацию обо всех заметка в формате дата, тема, имя, ИД"""
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             data = list(connection.execute("""SELECT date, theme, name, id FROM notes"""))
-        connection.close()        
         return data
 
     def add_note(self, date: str, name: str, theme: str, directory_id: int) -> None:
         '''Добавить заметку
         корневая директория - 0'''
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
-            cursor.execute('INSERT INTO objects (type, parent) VALUES (?, ?)', ('notes', directory_id))
+            cursor.execute('INSERT INTO objects (type, parent, position) VALUES (?, ?, ?)',
+                           ('notes', directory_id, self._next_position(cursor, directory_id)))
             id_note = cursor.lastrowid
             cursor.execute('INSERT INTO notes (date, name, theme, id) VALUES (?, ?, ?, ?)', (date, name, theme, id_note))
-            if directory_id:
-                cursor.execute('UPDATE folders SET content = content || " " || (?) WHERE id = (?)',
-                               (id_note, directory_id))
-            else:
-                cursor.execute('INSERT INTO main_directory (id_obj) VALUES (?)', (id_note,))
-                
             connection.commit()
             cursor.close()
-        connection.close()
         
     def add_folder(self, date: str, name: str, theme: str, directory_id: int) -> None:
         '''Добавить папку
         корневая диреуктория - 0'''
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
-            cursor.execute('INSERT INTO objects (type, parent) VALUES (?, ?)', ('folders', directory_id))
+            cursor.execute('INSERT INTO objects (type, parent, position) VALUES (?, ?, ?)',
+                           ('folders', directory_id, self._next_position(cursor, directory_id)))
             folder_id = cursor.lastrowid
             cursor.execute('INSERT INTO folders (id, date, name, theme, content) VALUES (?, ?, ?, ?, ?)',
                            (folder_id, date, name, theme, ''))
-            if directory_id:
-                cursor.execute('UPDATE folders SET content = content || " " || (?) WHERE id = (?)',
-                               (folder_id, directory_id))
-            else:
-                cursor.execute('INSERT INTO main_directory (id_obj) VALUES (?)', (folder_id,))
             cursor.close()
-        connection.close()
 
-    def delete_file(self, id: int):
-        '''Удалить файл'''
-        with sq.connect(self.file) as connection:
+    def delete_file(self, id: int) -> dict:
+        '''Удалить файл вместе со всем содержимым
+        возвращает количество удалённых строк по таблицам'''
+        # id файла и всех вложенных объектов
+        subtree = '''(
+            WITH RECURSIVE subtree(id) AS (
+                SELECT (?)
+                UNION
+                SELECT objects.id FROM objects JOIN subtree ON objects.parent = subtree.id)
+            SELECT id FROM subtree)'''
+        deleted = {}
+        with self.connection as connection:
             cursor = connection.cursor()
-            if self.get_type_file(id) == 'folders':
-                data = cursor.execute('SELECT content FROM folders WHERE id = (?)', (id, )).fetchone()[0]
-                for i in data.split():
-                    self.delete_file(int(i))
-                parent = int(cursor.execute('SELECT parent FROM objects WHERE id = (?)', (id, )).fetchone()[0])
-                cursor.execute('DELETE FROM objects WHERE id = (?)', (id, ))
-                cursor.execute('DELETE FROM folders WHERE id = (?)', (id, ))
-                if parent:
-                    content = cursor.execute('SELECT content FROM folders WHERE id = (?)', (parent, )).fetchone()[0]
-                    content = content.split()
-                    content.remove(str(id))
-                    content = ' '.join(content)
-                    cursor.execute('UPDATE folders SET content = (?) WHERE id = (?)', (content, parent))
-                else:
-                    cursor.execute('DELETE FROM main_directory WHERE id_obj = (?)', (id, ))
-            else:
-                parent = int(cursor.execute('SELECT parent FROM objects WHERE id = (?)', (id, )).fetchone()[0])
-                cursor.execute('DELETE FROM objects WHERE id = (?)', (id, ))
-                cursor.execute('''DELETE FROM notes_data WHERE note_id=?''', (id, ))
-                cursor.execute('DELETE FROM notes WHERE id = (?)', (id, ))
-                if parent:
-                    content = cursor.execute('SELECT content FROM folders WHERE id = (?)', (parent, )).fetchone()[0]
-                    content = content.split()
-                    content.remove(str(id))
-                    content = ' '.join(content)
-                    cursor.execute('UPDATE folders SET content = (?) WHERE id = (?)', (content, parent))
-                else:
-                    cursor.execute('DELETE FROM main_directory WHERE id_obj = (?)', (id, ))
-                cursor.close()
-        connection.close()
+            cursor.execute('BEGIN')
+            for table, column in (('notes_data', 'note_id'), ('notes', 'id'), ('folders', 'id'), ('objects', 'id')):
+                deleted[table] = cursor.execute(f'DELETE FROM {table} WHERE {column} IN {subtree}', (id, )).rowcount
+            cursor.close()
+        self._folders_cache.clear()
+        return deleted
         
     def check_main_directory(self) -> list:
         """Получить id элементов в корневой директории"""
-        with sq.connect(self.file) as connection:
-            data = list(connection.execute('SELECT id_obj FROM main_directory'))
-        connection.close()
+        with self.connection as connection:
+            data = list(connection.execute('SELECT id FROM objects WHERE parent = 0 ORDER BY position'))
         return data
 
     def info_about_note(self, id_note: int) -> list:
         """Получить информацию о заметке по id"""
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             data = list(connection.execute('SELECT * FROM notes WHERE id = (?)', (id_note,)))
-        connection.close()
         return data[0]
 
     def info_about_folder(self, folder_id: int) -> list:
         """Получить информацию о папке по id"""
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             data = list(connection.execute('SELECT * FROM folders WHERE id = (?)', (folder_id,)))
-        connection.close()
         return data[0]
 
-    def get_content_folder(self, direction_id: int) -> list:
-        """Получить информацию о папке в формате имя, дата, тема"""
-        with sq.connect(self.file) as connection:
-            cursor = connection.cursor()
-            if direction_id:
-                cursor.execute('SELECT content FROM folders WHERE id = (?)', (direction_id,))
-                data = str(cursor.fetchone()[0])
-                result = []
-                for id_obj in data.split():
-                    cursor.execute('SELECT type FROM objects WHERE id = (?)', (id_obj,))
-                    type_obj = cursor.fetchone()[0]
-                    cursor.execute(f'SELECT name, date, theme FROM {type_obj} WHERE id = (?)', (id_obj,))
-                    result.append(cursor.fetchone() + (type_obj, id_obj))
-            else:
-                cursor.execute('SELECT * FROM main_directory')
-                data = cursor.fetchall()
-                result = []
-                for id_obj in data:
-                    cursor.execute('SELECT type FROM objects WHERE id = (?)', (id_obj[0],))
-                    type_obj = cursor.fetchone()[0]
-                    cursor.execute(f'SELECT name, date, theme FROM {type_obj} WHERE id = (?)', (id_obj[0],))
-                    result.append(cursor.fetchone() + (type_obj, id_obj[0]))
-                cursor.close()
-        connection.close()
+    def get_content_folder(self, direction_id: int, limit: int = -1, offset: int = 0) -> list:
+        """Получить информацию о папке в формате имя, дата, тема, тип, ИД
+        limit, offset - постраничная выдача, limit = -1 - без ограничения"""
+        with self.connection as connection:
+            result = connection.execute('''
+            SELECT COALESCE(notes.name, folders.name), COALESCE(notes.date, folders.date),
+                   COALESCE(notes.theme, folders.theme), objects.type, objects.id
+            FROM objects
+            LEFT JOIN notes ON notes.id = objects.id
+            LEFT JOIN folders ON folders.id = objects.id
+            WHERE objects.parent = (?)
+            ORDER BY objects.position
+            LIMIT (?) OFFSET (?)''', (direction_id, limit, offset)).fetchall()
         return result
 
     def get_type_file(self, id_file: int) -> str:
         """Получить тип файла"""
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
             data = cursor.execute('SELECT type FROM objects WHERE id = ?', (id_file, )).fetchone()[0]
             cursor.close()
-        connection.close()
         return data
 
     def get_parent_file(self, id_file: int) -> int:
         """Получить нахождение файла"""
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
             data = cursor.execute('SELECT parent FROM objects WHERE id = ?', (id_file, )).fetchone()[0]
             cursor.close()
-        connection.close()
         return data
 
     def clear_note_content(self, note_id):
         '''Удалить содержание заметки'''
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
             cursor.execute('''DELETE FROM notes_data WHERE note_id=?''', (note_id, ))
             cursor.close()
-        connection.close()
 
     def add_note_content(self, type, coords, size, content, note_id, args=None):
         '''Добавить содержание заметки'''
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
+            stored, blob_hash = store_blob(cursor, type, content)
             cursor.execute('''
-            INSERT INTO notes_data (note_data_type,
-            note_data_coords, note_data_size, note_data_content, note_id, note_data_args) VALUES (?, ?, ?, ?, ?, ?)''',
-                           (type, coords, size, content, note_id, args))
+            INSERT INTO notes_data (note_data_type, note_data_coords, note_data_size, note_data_content,
+            note_data_blob, note_id, note_data_args, note_data_layer)
+            VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT COUNT(*) FROM notes_data WHERE note_id = ?))''',
+                           (type, coords, size, stored, blob_hash, note_id, args, note_id))
+            index_contents(cursor, [(cursor.lastrowid, note_id, type, content)])
+            cursor.close()
+
+    @staticmethod
+    def _insert_note_contents(cursor: sq.Cursor, note_id: int, elements: list) -> list:
+        '''Вставить элементы заметки одним executemany внутри уже открытой транзакции
+        Возвращает note_data_id элементов в порядке elements'''
+        if not elements:
+            return []
+        # note_data_id назначаются явно, чтобы не получать lastrowid для каждой строки
+        first_id = cursor.execute('''
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'notes_data'), 0),
+                   COALESCE((SELECT MAX(note_data_id) FROM notes_data), 0)) + 1''').fetchone()[0]
+        ids = list(range(first_id, first_id + len(elements)))
+        contents = [store_blob(cursor, element['type'], element['content']) for element in elements]
+        cursor.executemany('''
+        INSERT INTO notes_data (note_data_id, note_id, note_data_type, note_data_coords, note_data_content,
+        note_data_blob, note_data_size, note_data_args, note_data_layer) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           [(data_id, note_id, element['type'], element['coords'], content, blob_hash,
+                             element['size'], element.get('args', ''), element['layer'])
+                            for data_id, element, (content, blob_hash) in zip(ids, elements, contents)])
+        index_contents(cursor, [(data_id, note_id, element['type'], element['content'])
+                                for data_id, element in zip(ids, elements)])
+        return ids
+
+    def add_note_contents(self, note_id: int, elements) -> list:
+        '''Добавить много элементов заметки одной транзакцией
+        elements - словари с ключами type, coords, size, content, args, layer
+        Возвращает note_data_id элементов в порядке elements'''
+        elements = list(elements)
+        with self.connection as connection:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            ids = self._insert_note_contents(cursor, note_id, elements)
             cursor.close()
-        connection.close()
+        return ids
+
+    def save_note_changes(self, note_id: int, elements: list, deleted: list) -> list:
+        '''Сохранить изменения заметки одной транзакцией
+        elements - изменённые элементы, словари с ключами data_id, type, coords, size, content, args, layer;
+        data_id = None - новый элемент, content = None - содержимое не изменилось
+        deleted - note_data_id удалённых элементов
+        Возвращает note_data_id элементов в порядке elements'''
+        new = [element for element in elements if element['data_id'] is None]
+        old = [element for element in elements if element['data_id'] is not None]
+        with self.connection as connection:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.executemany('DELETE FROM notes_data WHERE note_data_id = ?', [(i, ) for i in deleted])
+            new_ids = iter(self._insert_note_contents(cursor, note_id, new))
+            cursor.executemany('UPDATE notes_data SET note_data_content = ?, note_data_blob = ? WHERE note_data_id = ?',
+                               [store_blob(cursor, element['type'], element['content']) + (element['data_id'], )
+                                for element in old if element['content'] is not None])
+            index_contents(cursor, [(element['data_id'], note_id, element['type'], element['content'])
+                                    for element in old if element['content'] is not None])
+            cursor.executemany('''
+            UPDATE notes_data SET note_data_coords = ?, note_data_size = ?, note_data_args = ?, note_data_layer = ?
+            WHERE note_data_id = ?''', [(element['coords'], element['size'], element['args'], element['layer'],
+                                         element['data_id']) for element in old])
+            cursor.close()
+        return [next(new_ids) if element['data_id'] is None else element['data_id'] for element in elements]
 
     def get_note_content(self, note_id):
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
-            data = cursor.execute('SELECT * FROM notes_data WHERE note_id = ?', (str(note_id), )).fetchall()
+            data = cursor.execute('''
+            SELECT note_id, note_data_id, note_data_type, note_data_coords,
+            COALESCE(note_data_content, blobs.content), note_data_size, note_data_args
+            FROM notes_data LEFT JOIN blobs ON blobs.hash = notes_data.note_data_blob
+            WHERE note_id = ? ORDER BY note_data_layer, note_data_id''', (str(note_id), )).fetchall()
             cursor.close()
-        connection.close()
         return data
 
+    def search(self, text: str, limit: int = 50) -> list:
+        '''Найти элементы заметок по тексту, лучшие по bm25 совпадения первыми
+        ранжируются все совпадения, если их не больше SEARCH_CANDIDATES, иначе SEARCH_CANDIDATES последних
+        Возвращает [(ИД заметки, имя заметки, note_data_id, тип элемента, фрагмент текста), ...],
+        найденные слова во фрагменте выделены [ ]'''
+        query = search_query(text)
+        if not query:
+            return []
+        with self.connection as connection:
+            # bm25 в выражении сортируется с ограничением LIMIT, ORDER BY rank сортировал бы все совпадения
+            ids = [data_id for data_id, in connection.execute('''
+            SELECT rowid FROM (SELECT rowid, bm25(notes_search) AS score FROM notes_search
+                               WHERE notes_search MATCH (?) ORDER BY rowid DESC LIMIT (?))
+            ORDER BY score LIMIT (?)''', (query, SEARCH_CANDIDATES, limit))]
+            if not ids:
+                return []
+            # фрагменты строятся только для найденных элементов
+            data = connection.execute(f'''
+            SELECT notes_search.note_id, notes.name, notes_search.rowid, notes_data.note_data_type,
+                   snippet(notes_search, 0, '[', ']', '…', 12)
+            FROM notes_search
+            JOIN notes ON notes.id = notes_search.note_id
+            JOIN notes_data ON notes_data.note_data_id = notes_search.rowid
+            WHERE notes_search MATCH (?) AND notes_search.rowid IN ({', '.join('?' * len(ids))})''',
+                                      (query, *ids)).fetchall()
+        order = {data_id: i for i, data_id in enumerate(ids)}
+        return sorted(data, key=lambda row: order[row[2]])
+
+    def count_matches(self, text: str) -> int:
+        '''Количество элементов заметок, в которых есть все слова text'''
+        query = search_query(text)
+        if not query:
+            return 0
+        with self.connection as connection:
+            return connection.execute('SELECT COUNT(*) FROM notes_search WHERE notes_search MATCH (?)',
+                                      (query, )).fetchone()[0]
+
+    def get_note_layout(self, note_id: int) -> list:
+        '''Получить элементы заметки в формате get_note_content без загрузки картинок и файлов
+        вместо содержимого из blobs возвращается LazyBlob'''
+        with self.connection as connection:
+            data = connection.execute('''
+            SELECT note_id, note_data_id, note_data_type, note_data_coords, note_data_content, note_data_size,
+            note_data_args, note_data_blob, LENGTH(blobs.content)
+            FROM notes_data LEFT JOIN blobs ON blobs.hash = notes_data.note_data_blob
+            WHERE note_id = ? ORDER BY note_data_layer, note_data_id''', (note_id, )).fetchall()
+        result = []
+        for *row, blob_hash, size in data:
+            if blob_hash is not None:
+                row[4] = LazyBlob(self, blob_hash, size)
+            result.append(tuple(row))
+        return result
+
+    def collect_garbage(self) -> int:
+        '''Пересчитать ссылки на blobs и удалить неиспользуемые
+        Возвращает количество удалённых blobs'''
+        with self.connection as connection:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+            UPDATE blobs SET refcount = (SELECT COUNT(*) FROM notes_data WHERE note_data_blob = blobs.hash)''')
+            removed = cursor.execute('DELETE FROM blobs WHERE refcount <= 0').rowcount
+            cursor.close()
+        return removed
+
+    def blob_report(self) -> dict:
+        '''Статистика дедупликации картинок и файлов'''
+        with self.connection as connection:
+            references, blobs, stored_size, logical_size = connection.execute('''
+            SELECT COALESCE(SUM(refcount), 0), COUNT(*), COALESCE(SUM(LENGTH(content)), 0),
+                   COALESCE(SUM(LENGTH(content) * refcount), 0) FROM blobs''').fetchone()
+        return {'references': references, 'blobs': blobs,
+                'stored_size': stored_size, 'logical_size': logical_size,
+                'dedup_ratio': logical_size / stored_size if stored_size else 1.0}
+
+    def get_path(self, folder_id: int) -> list:
+        '''Получить путь к папке в формате [(ИД, имя), ...] от корневой директории'''
+        path = []
+        while folder_id:
+            if folder_id not in self._folders_cache:
+                self._load_ancestors(folder_id)
+            name, parent = self._folders_cache[folder_id]
+            path.append((folder_id, name))
+            folder_id = parent
+        return path[::-1]
+
+    def _load_ancestors(self, folder_id: int) -> None:
+        '''Загрузить в кэш папку folder_id и все папки выше неё одним запросом'''
+        with self.connection as connection:
+            data = connection.execute('''
+            WITH RECURSIVE ancestors(id, name, parent) AS (
+                SELECT folders.id, folders.name, objects.parent
+                FROM folders JOIN objects ON objects.id = folders.id
+                WHERE folders.id = (?)
+                UNION
+                SELECT folders.id, folders.name, objects.parent
+                FROM ancestors
+                JOIN folders ON folders.id = ancestors.parent
+                JOIN objects ON objects.id = folders.id)
+            SELECT id, name, parent FROM ancestors''', (folder_id, )).fetchall()
+        for id_folder, name, parent in data:
+            self._folders_cache[id_folder] = (name, parent)
+
     def change_file_name(self, note_id: int, name: str):
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
             cursor.execute(f'UPDATE {self.get_type_file(note_id)} SET name = (?) WHERE id = (?)', (name, note_id))
             cursor.close()
-        connection.close()
+        self._folders_cache.pop(note_id, None)
 
     def change_file_theme(self, note_id: int, theme: str):
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
             cursor.execute(f'UPDATE {self.get_type_file(note_id)} SET theme = (?) WHERE id = (?)', (theme, note_id))
             cursor.close()
-        connection.close()
 
     def remove_file(self, id_file: int, new_directory: int):
-        with sq.connect(self.file) as connection:
+        with self.connection as connection:
             cursor = connection.cursor()
-            parent_file = self.get_parent_file(id_file)
-            if parent_file:
-                content = cursor.execute('SELECT content FROM folders WHERE id = (?)', (parent_file, )).fetchone()[0]
-                content = content.split()
-                content.remove(str(id_file))
-                content = ' '.join(content)
-                cursor.execute('UPDATE folders SET content = (?) WHERE id = (?)', (content, parent_file))
-            else:
-                cursor.execute('DELETE FROM main_directory WHERE id_obj = (?)', (id_file, ))
-            cursor.execute('UPDATE objects SET parent = (?) WHERE id = (?)', (new_directory, id_file))
-            if new_directory:
-                cursor.execute('UPDATE folders SET content = content || " " || (?) WHERE id = (?)',
-                               (id_file, new_directory))
-            else:
-                cursor.execute('INSERT INTO main_directory (id_obj) VALUES (?)', (id_file,))
+            cursor.execute('UPDATE objects SET parent = (?), position = (?) WHERE id = (?)',
+                           (new_directory, self._next_position(cursor, new_directory), id_file))
             connection.commit()
             cursor.close()
-        connection.close()
+        self._folders_cache.pop(id_file, None)
+
+
+if __name__ == '__main__':
+    # отчёт о дедупликации: python database.py [файл базы данных]
+    with DataBase(argv[1] if len(argv) > 1 else 'db.db') as database:
+        for key, value in database.blob_report().items():
+            print(f'{key}: {value}')
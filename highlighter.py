@@ -1,8 +1,13 @@
 from PyQt6.QtWidgets import QTextEdit, QApplication
-from PyQt6.QtGui import QSyntaxHighlighter, QTextCharFormat, QFont, QColor, QBrush
+from PyQt6.QtGui import QSyntaxHighlighter, QTextCharFormat, QTextLayout, QFont, QColor, QBrush
+from PyQt6.QtCore import QTimer
+from time import perf_counter
 import sys
 import re
 
+FRAME_BUDGET = 0.008    # секунд подсветки подряд, дальше строки подсвечиваются по таймеру
+PENDING = 1             # бит состояния строки, которая ещё не подсвечена
+
 
 def text_format(bc=None, fc=None, bold=False, italic=False):
     '''Создание стиля'''
@@ -17,75 +22,396 @@ def text_format(bc=None, fc=None, bold=False, italic=False):
     return format
 
 
-syntax_formats = {
-    r'#+.*': text_format(fc='red'),
-    r"'.*?'": text_format(fc='green'),
-    r'".*?"': text_format(fc='green'),
-    r'\b((?<=class)|(?<=def)).*?(?=:|\()': text_format(fc='blue')}
-
 keywords = ['class', 'def', 'if', 'elif', 'else', 'match', 'and', 'or',
             'not', 'in', 'for', 'while', 'try', 'except', 'finally',
             'from', 'import', 'as', 'None', 'True', 'False', 'return']
-keywords_syntax = {}
-for i in keywords:
-    keywords_syntax[r'\b' + i + r'\b'] = text_format(fc='dark orange')
 
-syntax_formats = keywords_syntax | syntax_formats
- 
+themes = {'Light': {'comment': 'red', 'string': 'green', 'keyword': 'dark orange',
+                    'name': 'blue', 'number': 'dark cyan'},
+          'Dark': {'comment': '#ff6b6b', 'string': '#98c379', 'keyword': '#e5a550',
+                   'name': '#61afef', 'number': '#56b6c2'}}
+formats_cache = {}
+
+
+def theme_formats(theme='Light', bold=False):
+    """Стили видов токенов для темы, создаются один раз и общие для всех подсветок, менять их нельзя"""
+    if (theme, bold) not in formats_cache:
+        formats_cache[theme, bold] = {kind: text_format(fc=color, bold=bold) for kind, color in themes[theme].items()}
+    return formats_cache[theme, bold]
+
+
+def words(*names):
+    """Регулярное выражение для списка слов"""
+    return r'\b(?:' + '|'.join(names) + r')\b'
+
+
+class Language:
+    """Правила подсветки языка
+    rules - (вид токена, регулярное выражение) в порядке приоритета, выражение вида define
+    может содержать группу name - имя после ключевого слова
+    blocks - (начало, конец, вид) конструкций, которые могут продолжаться на следующих строках
+    все правила собираются в одно регулярное выражение при первой подсветке"""
+    def __init__(self, name, rules, blocks=(), aliases=()):
+        self.name = name
+        self.rules = rules
+        self.blocks = blocks
+        self.aliases = (name.lower(), ) + aliases
+        self.regex = None
+        self.kinds = {}
+        self.formats_cache = {}
+
+    def compile(self):
+        patterns = []
+        for i, (start, end, kind) in enumerate(self.blocks):
+            # закрытая на этой же строке конструкция и открытая до конца строки
+            patterns.append(f'(?P<closed{i}>{re.escape(start)}.*?{re.escape(end)})')
+            patterns.append(f'(?P<opened{i}>{re.escape(start)}.*)')
+            self.kinds[f'closed{i}'] = kind
+        for i, (kind, pattern) in enumerate(self.rules):
+            patterns.append(f'(?P<rule{i}>{pattern})')
+            self.kinds[f'rule{i}'] = kind
+        self.regex = re.compile('|'.join(patterns))
+
+    def tokens(self, text):
+        """Разбор строки за один проход: (начало, длина, вид) для каждого токена
+        openedN - конструкция blocks[N], не закрытая до конца строки"""
+        if self.regex is None:
+            self.compile()
+        kinds = self.kinds
+        for match_ in self.regex.finditer(text):
+            kind = kinds.get(match_.lastgroup, match_.lastgroup)
+            start, end = match_.span()
+            if kind == 'define':
+                # ключевое слово, за ним имя
+                name_start = match_.start('name')
+                if name_start != -1:
+                    yield start, name_start - start, 'keyword'
+                    yield name_start, end - name_start, 'name'
+                    continue
+                kind = 'keyword'
+            yield start, end - start, kind
+
+    def line(self, text, block=0):
+        """Разбор строки, block - 1 + номер в blocks конструкции, открытой на предыдущих строках, 0 - нет
+        возвращает список (начало, длина, вид) и такой же номер конструкции, открытой на конце строки"""
+        tokens = []
+        start = 0
+        if block:
+            # продолжение конструкции с предыдущей строки
+            block_start, block_end, kind = self.blocks[block - 1]
+            close = text.find(block_end)
+            if close == -1:
+                return [(0, len(text), kind)], block
+            start = close + len(block_end)
+            tokens.append((0, start, kind))
+            block = 0
+        for token_start, length, kind in self.tokens(text[start:] if start else text):
+            tokens.append((start + token_start, length, kind))
+            if kind.startswith('opened'):
+                block = int(kind[6:]) + 1
+        return tokens, block
+
+    def formats(self, theme='Light', bold=False):
+        """Стиль для каждого вида токена этого языка"""
+        if (theme, bold) not in self.formats_cache:
+            formats = dict(theme_formats(theme, bold))
+            for i, (start, end, kind) in enumerate(self.blocks):
+                formats[f'opened{i}'] = formats[kind]
+            self.formats_cache[theme, bold] = formats
+        return self.formats_cache[theme, bold]
+
+
+string = r"'(?:\\.|[^'\\])*'" + '|' + r'"(?:\\.|[^"\\])*"'
+number = r'\b(?:0[xX][0-9a-fA-F]+|\d+\.?\d*(?:[eE][+-]?\d+)?)\b'
+languages = {language.name: language for language in (
+    Language('Python', [('comment', r'#.*'),
+                        ('string', string),
+                        ('define', r'\b(?:class|def)\b(?P<name>[^:(]*(?=[:(]))?'),
+                        ('keyword', words(*keywords, 'with', 'yield', 'lambda', 'pass', 'break', 'continue',
+                                          'global', 'nonlocal', 'is', 'raise', 'del', 'assert', 'async', 'await')),
+                        ('number', number)],
+             blocks=(("'''", "'''", 'string'), ('"""', '"""', 'string')), aliases=('py', )),
+    Language('SQL', [('comment', r'--.*'),
+                     ('string', r"'(?:''|[^'])*'"),
+                     ('name', r'"[^"]*"'),
+                     ('keyword', '(?i:' + words(
+                         'select', 'from', 'where', 'insert', 'into', 'values', 'update', 'set', 'delete',
+                         'create', 'drop', 'alter', 'table', 'index', 'view', 'trigger', 'if', 'exists',
+                         'join', 'left', 'right', 'inner', 'outer', 'on', 'using', 'and', 'or', 'not', 'null',
+                         'is', 'in', 'as', 'like', 'between', 'order', 'group', 'by', 'having', 'limit', 'offset',
+                         'distinct', 'union', 'all', 'case', 'when', 'then', 'else', 'end', 'primary', 'foreign',
+                         'key', 'references', 'default', 'integer', 'text', 'blob', 'real', 'begin', 'commit') + ')'),
+                     ('number', number)],
+             blocks=(('/*', '*/', 'comment'), ), aliases=('sqlite', )),
+    Language('JavaScript', [('comment', r'//.*'),
+                            ('string', string + '|' + r'`(?:\\.|[^`\\])*`'),
+                            ('define', r'\b(?:function|class)\b(?P<name>\s*[\w$]+)?'),
+                            ('keyword', words(
+                                'var', 'let', 'const', 'return', 'if', 'else', 'for', 'while', 'do', 'switch', 'case',
+                                'break', 'continue', 'new', 'this', 'extends', 'import', 'export', 'from', 'default',
+                                'try', 'catch', 'finally', 'throw', 'typeof', 'instanceof', 'in', 'of', 'null',
+                                'undefined', 'true', 'false', 'async', 'await', 'yield', 'delete')),
+                            ('number', number)],
+             blocks=(('/*', '*/', 'comment'), ), aliases=('js', )),
+    Language('C', [('comment', r'//.*'),
+                   ('string', string),
+                   ('keyword', r'^\s*#\s*\w+'),
+                   ('keyword', words(
+                       'int', 'char', 'float', 'double', 'void', 'long', 'short', 'unsigned', 'signed', 'struct',
+                       'union', 'enum', 'typedef', 'static', 'const', 'extern', 'return', 'if', 'else', 'for',
+                       'while', 'do', 'switch', 'case', 'break', 'continue', 'default', 'goto', 'sizeof', 'NULL')),
+                   ('number', number)],
+             blocks=(('/*', '*/', 'comment'), ), aliases=('h', )),
+    Language('Bash', [('comment', r'(?<![\w$])#.*'),
+                      ('string', string),
+                      ('name', r'\$\{[^}]*\}|\$\w+'),
+                      ('keyword', words(
+                          'if', 'then', 'else', 'elif', 'fi', 'for', 'while', 'until', 'do', 'done', 'case', 'esac',
+                          'function', 'in', 'return', 'export', 'local', 'echo', 'exit', 'source'))],
+             aliases=('sh', 'shell')),
+    Language('JSON', [('name', r'"(?:\\.|[^"\\])*"(?=\s*:)'),
+                      ('string', r'"(?:\\.|[^"\\])*"'),
+                      ('keyword', words('true', 'false', 'null')),
+                      ('number', r'-?' + number)])
+)}
+# номер языка в состоянии строки подсветки блоков ```, 0 - неизвестный язык
+language_ids = {alias: i for i, language in enumerate(languages.values(), 1) for alias in language.aliases}
+language_ids[''] = language_ids['python']
+languages_by_id = [None] + list(languages.values())
+
+
+def find_language(alias: str) -> str | None:
+    """Название языка по его другому названию или расширению файла, None - язык неизвестен"""
+    language = languages_by_id[language_ids.get(alias.lower(), 0)]
+    return language.name if language else None
+
+
+def code_format():
+    """Стиль кода в тексте заметки, создаётся при первой подсветке"""
+    if 'code' not in formats_cache:
+        formats_cache['code'] = text_format(bold=True)
+    return formats_cache['code']
+
+
+inline_code_regex = re.compile('`[^`]+`')
+
 
 class PythonSyntaxHighlighterInBlockCode(QSyntaxHighlighter):
+    """Подсветка `кода` и блоков ```язык ... ``` в тексте заметки, ``` без языка - Python
+    состояние строки - число: бит 0 - внутри ```, биты 1-3 - открытая многострочная конструкция
+    (1 + номер в blocks языка), остальные биты - номер языка блока. Состояние зависит только от предыдущей
+    строки и текста, поэтому Qt перестаёт подсвечивать следующие строки, как только состояние совпадает с прежним"""
+    def __init__(self, document, theme='Light'):
+        super().__init__(document)
+        self.theme = theme
+        self.code_format = code_format()
+
     def highlightBlock(self, text):
         try:
-            for code_text in re.finditer('`.*`', text):
-                self.setFormat(code_text.start(), code_text.end() - code_text.start(), text_format(bold=True))
-                for pattern, format in syntax_formats.items():
-                    format.setFontWeight(QFont.Weight.Bold)
-                    for match_ in re.finditer(pattern, text[code_text.start():code_text.end()]):
-                        start, end = match_.span()
-                        self.setFormat(start, end - start, format)
-
-            self.setCurrentBlockState(0)
-            start_index = 0
-            end_index = len(text)
-            if self.previousBlockState() != 1:
-                for block_code in re.finditer(r'```.*', text):
-                    self.setFormat(block_code.start(), block_code.end() - block_code.start(), text_format(bold=True))
-                    start_index = block_code.start()
-                    end_index_ = re.search(r'.*```', text[start_index + 3:])
-                    self.setCurrentBlockState(1)
-                    if end_index_ is not None:
-                        end_index = end_index_.end() + start_index
-                        self.setCurrentBlockState(0)
-                    for pattern, format in syntax_formats.items():
-                        format.setFontWeight(QFont.Weight.Bold)
-                        for match_ in re.finditer(pattern, text[start_index + 3:end_index]):
-                            start, end = match_.span()
-                            self.setFormat(start + start_index + 3, end - start + start_index, format)
-            else:
-                self.setCurrentBlockState(1)
-                end_index_ = re.search(r'.*```', text)
-                if end_index_ is not None:
-                    end_index = end_index_.end()
-                    self.setCurrentBlockState(0)
-                self.setFormat(0, end_index, text_format(bold=True))
-                for pattern, format in syntax_formats.items():
-                    format.setFontWeight(QFont.Weight.Bold)
-                    for match_ in re.finditer(pattern, text[start_index:end_index]):
-                        start, end = match_.span()
-                        self.setFormat(start + start_index, end - start + start_index, format)
+            self.setCurrentBlockState(self.highlight_line(text, max(self.previousBlockState(), 0)))
         except Exception as e:
             print(e)
 
+    def highlight_line(self, text, state):
+        """Подсветка строки, возвращает состояние на её конце"""
+        index = 0
+        inline_state = 1 | language_ids[''] << 4
+        while True:
+            if state & 1:
+                end = text.find('```', index)
+                code_end = len(text) if end == -1 else end
+                state = self.highlight_code(text, index, code_end, state)
+                if end == -1:
+                    break
+                self.setFormat(end, 3, self.code_format)
+                state = 0
+                index = end + 3
+            else:
+                start = text.find('```', index)
+                self.highlight_inline_code(text, index, len(text) if start == -1 else start, inline_state)
+                if start == -1:
+                    break
+                end = text.find('```', start + 3)
+                if end == -1:
+                    # строка открывает блок, после ``` идёт название языка
+                    self.setFormat(start, len(text) - start, self.code_format)
+                    state = 1 | language_ids.get(text[start + 3:].strip().lower(), 0) << 4
+                    break
+                # ```код``` в одной строке
+                self.setFormat(start, 3, self.code_format)
+                self.highlight_code(text, start + 3, end, inline_state)
+                self.setFormat(end, 3, self.code_format)
+                index = end + 3
+        return state
+
+    def highlight_inline_code(self, text, start, end, state):
+        """Подсветка `кода` в части строки"""
+        for match_ in inline_code_regex.finditer(text, start, end):
+            self.setFormat(match_.start(), match_.end() - match_.start(), self.code_format)
+            self.highlight_code(text, match_.start() + 1, match_.end() - 1, state)
+
+    def highlight_code(self, text, start, end, state):
+        """Подсветка части строки внутри блока кода, возвращает состояние на конце части"""
+        self.setFormat(start, end - start, self.code_format)
+        language = languages_by_id[state >> 4]
+        if language is None:
+            return state
+        formats = language.formats(self.theme, bold=True)
+        tokens, block = language.line(text[start:end], state >> 1 & 7)
+        for token_start, length, kind in tokens:
+            self.setFormat(start + token_start, length, formats[kind])
+        return state & ~14 | block << 1
+
+
+class CodeSyntaxHighlighter(QSyntaxHighlighter):
+    '''Подсветка кода на языке language (название из languages)
+    состояние строки - число: бит 0 (PENDING) - строка ещё не подсвечена, биты 1-3 - открытая
+    многострочная конструкция (1 + номер в blocks языка), у отложенной строки - последняя известная
+    за один раз строки подсвечиваются не дольше FRAME_BUDGET, остальные помечаются PENDING
+    и подсвечиваются частями по таймеру: сначала показанные прокруткой editor, потом по порядку'''
+    def __init__(self, document, editor=None, language='Python', theme='Light'):
+        super().__init__(document)
+        self.editor = editor
+        self.language = languages[language]
+        self.theme = theme
+        self.formats = self.language.formats(theme)
+        self.deadline = None
+        self.deferring = False
+        self.next_pending = 0
+        # позиции начала и конца видимого текста после прокрутки, подсвечиваются первыми
+        self.visible = None
+        self.timer = QTimer(self)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.highlight_pending)
+        document.contentsChange.connect(self.contents_changed)
+        if editor is not None:
+            editor.verticalScrollBar().valueChanged.connect(self.scrolled)
 
-class PythonSyntaxHighlighter(QSyntaxHighlighter):
     def highlightBlock(self, text):
+        if self.deferring:
+            # состояние не меняется у уже отложенной строки, поэтому Qt не идёт дальше по документу
+            self.setCurrentBlockState(max(self.currentBlockState(), 0) | PENDING)
+            return
+        if self.deadline is None:
+            # начало подсветки, бюджет сбрасывается, когда управление вернётся в цикл событий
+            self.deadline = perf_counter() + FRAME_BUDGET
+            QTimer.singleShot(0, self.reset_deadline)
+        elif perf_counter() > self.deadline:
+            # Qt подсвечивает строки по порядку, дальше до конца изменения откладываются все
+            self.deferring = True
+            self.defer()
+            return
+        previous = max(self.previousBlockState(), 0)
+        if previous & PENDING:
+            # начало строки зависит от ещё не подсвеченной строки выше
+            self.defer()
+            return
         try:
-            for pattern, format in syntax_formats.items():
-                for match_ in re.finditer(pattern, text):
-                    start, end = match_.span()
-                    self.setFormat(start, end - start, format)     
+            tokens, block = self.language.line(text, previous >> 1 & 7)
+            for start, length, kind in tokens:
+                self.setFormat(start, length, self.formats[kind])
         except Exception as e:
             print(e)
+            block = 0
+        self.setCurrentBlockState(block << 1)
+
+    def defer(self):
+        '''Отложить подсветку текущей строки'''
+        self.next_pending = min(self.next_pending, self.currentBlock().blockNumber())
+        self.timer.start()
+        self.setCurrentBlockState(max(self.currentBlockState(), 0) | PENDING)
+
+    def set_language(self, language: str) -> None:
+        """Сменить язык, language - название из languages"""
+        if language == self.language.name:
+            return
+        self.language = languages[language]
+        self.formats = self.language.formats(self.theme)
+        self.highlight_again()
+
+    def set_theme(self, theme: str) -> None:
+        """Сменить тему, theme - название из themes"""
+        if theme == self.theme:
+            return
+        self.theme = theme
+        self.formats = self.language.formats(theme)
+        self.highlight_again()
+
+    def highlight_again(self) -> None:
+        """Подсветить весь документ заново по таймеру, старая подсветка видна до замены
+        rehighlight на показанном документе пересчитывал бы разметку на каждой строке"""
+        block = self.document().begin()
+        while block.isValid():
+            block.setUserState(max(block.userState(), 0) | PENDING)
+            block = block.next()
+        self.next_pending = 0
+        self.timer.start()
+
+    def scrolled(self):
+        '''Показались другие строки, среди них могут быть отложенные'''
+        viewport = self.editor.viewport().rect()
+        self.visible = (self.editor.cursorForPosition(viewport.topLeft()).position(),
+                        self.editor.cursorForPosition(viewport.bottomRight()).position())
+        self.timer.start()
+
+    def reset_deadline(self):
+        self.deadline = None
+        self.deferring = False
+
+    def contents_changed(self, position, removed, added):
+        # отложенные строки после изменения могли сдвинуться вверх
+        self.next_pending = min(self.next_pending, self.document().findBlock(position).blockNumber())
+
+    def pending_blocks(self):
+        '''Отложенные строки: сначала показанные после прокрутки, потом по порядку с next_pending'''
+        document = self.document()
+        if self.visible is not None:
+            block, end = document.findBlock(self.visible[0]), document.findBlock(self.visible[1]).next()
+            while block.isValid() and block != end:
+                if max(block.userState(), 0) & PENDING:
+                    yield block
+                block = block.next()
+            self.visible = None
+        block = document.findBlockByNumber(self.next_pending)
+        while block.isValid():
+            self.next_pending = block.blockNumber()
+            if max(block.userState(), 0) & PENDING:
+                yield block
+            block = block.next()
+        self.next_pending = document.blockCount()
+
+    def highlight_pending(self):
+        '''Подсветить отложенные строки в пределах бюджета
+        форматы задаются прямо в QTextLayout строк, а документ оповещается один раз на все строки:
+        rehighlightBlock вне изменения текста пересчитывал бы разметку всего документа на каждой строке'''
+        deadline = perf_counter() + FRAME_BUDGET
+        first, last = self.document().characterCount(), 0
+        for block in self.pending_blocks():
+            # у отложенной строки выше берётся последняя известная конструкция, строка исправится,
+            # когда до неё дойдёт подсветка по порядку
+            tokens, opened = self.language.line(block.text(), max(block.previous().userState(), 0) >> 1 & 7)
+            ranges = []
+            for start, length, kind in tokens:
+                format_range = QTextLayout.FormatRange()
+                format_range.start, format_range.length = start, length
+                format_range.format = self.formats[kind]
+                ranges.append(format_range)
+            block.layout().setFormats(ranges)
+            if opened << 1 != max(block.userState(), 0) & ~PENDING:
+                # конструкция на конце строки изменилась, следующую строку нужно подсветить заново
+                following = block.next()
+                if following.isValid():
+                    following.setUserState(max(following.userState(), 0) | PENDING)
+                    self.next_pending = min(self.next_pending, following.blockNumber())
+            block.setUserState(opened << 1)
+            first = min(first, block.position())
+            last = max(last, block.position() + block.length())
+            if perf_counter() > deadline:
+                break
+        else:
+            self.timer.stop()
+        if first < last:
+            self.document().markContentsDirty(first, last - first)
 
 
 if __name__ == '__main__':          
@@ -1,12 +1,12 @@
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QToolBar,
-                             QScrollArea, QLayout,
-                             QMenu, QLineEdit, QLabel, QToolButton)
+                             QScrollArea, QLayout, QVBoxLayout,
+                             QMenu, QLineEdit, QLabel, QToolButton, QListWidget, QListWidgetItem)
 from PyQt6.QtCore import Qt, QSize, QPoint, QRect, pyqtSignal, pyqtSlot, QTimer
 from PyQt6.QtGui import QAction, QKeySequence, QIcon, QFont
 from sys import argv, exit
 from datetime import date
 
-from database import DataBase
+from database import DataBase, SEARCH_CANDIDATES
 from note_editor1 import NoteEditor
 from setting_menus import StyleSettingWindow, HelpWindow
 
@@ -205,9 +205,23 @@ class MainWindow(QMainWindow):
         self.now_path = QLabel(self)
         self.now_path.setObjectName('pathLabel')
 
+        # поиск по содержимому заметок, запускается после паузы в наборе
+        self.search_line = QLineEdit(self)
+        self.search_line.setPlaceholderText('Поиск')
+        self.search_line.setClearButtonEnabled(True)
+        self.search_line.setMaximumWidth(300)
+        self.search_timer = QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(200)
+        self.search_timer.timeout.connect(self.search)
+        self.search_line.textChanged.connect(self.search_timer.start)
+        self.search_line.returnPressed.connect(self.search)
+
         # добавление в toolbar_for_move
         toolbar_for_move.addAction(self.return_up_action)
         toolbar_for_move.addWidget(self.now_path)
+        toolbar_for_move.addSeparator()
+        toolbar_for_move.addWidget(self.search_line)
         
         self.addToolBar(toolbar_for_move)
 
@@ -222,8 +236,24 @@ class MainWindow(QMainWindow):
         work_area_scroll.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
         work_area_scroll.setWidgetResizable(True)
         work_area_scroll.setWidget(widget)
-        
-        self.setCentralWidget(work_area_scroll)
+
+        # результаты поиска над рабочей зоной
+        self.search_results = QListWidget()
+        self.search_results.itemDoubleClicked.connect(
+            lambda item: self.doubleclick_on_file_button(item.data(Qt.ItemDataRole.UserRole)))
+        self.search_results.hide()
+        # предупреждение, что отсортированы не все совпадения
+        self.search_info = QLabel()
+        self.search_info.setWordWrap(True)
+        self.search_info.hide()
+
+        central_widget = QWidget()
+        central_layout = QVBoxLayout(central_widget)
+        central_layout.setContentsMargins(0, 0, 0, 0)
+        central_layout.addWidget(self.search_info)
+        central_layout.addWidget(self.search_results)
+        central_layout.addWidget(work_area_scroll)
+        self.setCentralWidget(central_widget)
 
         # подключение базы данных
         self.database = DataBase('db.db')
@@ -280,12 +310,7 @@ class MainWindow(QMainWindow):
 
     def set_now_path(self):
         '''Установить текущий путь к папке'''
-        directory_id = self.now_directory
-        path = ''
-        while directory_id:
-            path = self.database.info_about_folder(directory_id)[1] + '/' + path
-            directory_id = self.database.get_parent_file(directory_id)
-        path = ':/' + path
+        path = ':/' + ''.join(name + '/' for _, name in self.database.get_path(self.now_directory))
         self.now_path.setText(path)
             
     def doubleclick_on_file_button(self, id_file):
@@ -297,11 +322,25 @@ class MainWindow(QMainWindow):
         else:
             try:
                 note_editor = NoteEditor(self, note_id=id_file)
-                note_editor.load_note(self.database.get_note_content(id_file))
                 note_editor.show()
+                note_editor.load_note_in_background(self.database, id_file)
             except Exception:
                 pass
 
+    def search(self):
+        '''Показать заметки, в тексте, коде или файлах которых есть искомые слова'''
+        self.search_timer.stop()
+        self.search_results.clear()
+        for note_id, name, _, type, fragment in self.database.search(self.search_line.text()):
+            item = QListWidgetItem(f'{name} ({type}): {" ".join(fragment.split())}')
+            item.setData(Qt.ItemDataRole.UserRole, note_id)
+            self.search_results.addItem(item)
+        self.search_results.setVisible(bool(self.search_line.text().strip()))
+        found = self.database.count_matches(self.search_line.text())
+        self.search_info.setText(f'Совпадений: {found}. Слишком много, чтобы отсортировать все: показаны лучшие '
+                                 f'из {SEARCH_CANDIDATES} последних. Уточните запрос, чтобы искать по всем заметкам.')
+        self.search_info.setVisible(found > SEARCH_CANDIDATES)
+
     def click_on_file_button(self, id_file):
         type_of_file = self.database.get_type_file(id_file)
         self.focus_file = id_file
@@ -333,6 +372,10 @@ class MainWindow(QMainWindow):
         menu.addAction(self.past_file_action)
         menu.exec(self.mapToGlobal(e.pos()))
             
+    def closeEvent(self, e):
+        self.database.close()
+        super().closeEvent(e)
+
     def update(self):
         self.load_from_database_directory(self.now_directory)
         super().update()
@@ -353,11 +396,6 @@ class MainWindow(QMainWindow):
             self.database.remove_file(self.cut_file, self.now_directory)
             self.update()
 
-    def save_note(self, type, coords, size, content, args='', note_id=1):
-        '''Сохранить запись'''
-        self.database.add_note_content(note_id=note_id, args=args, coords=str(coords),
-                                       size=str(size), content=content, type=type)
-
     def change_file_name(self):
         '''Изменить имя файла'''
         if self.focus_file:
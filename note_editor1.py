@@ -1,17 +1,52 @@
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QToolBar, QToolButton, QWidget,
                              QSizePolicy, QPushButton, QScrollArea, QColorDialog,
                              QFileDialog, QSpinBox, QTextEdit, QMenu, QLabel)
-from PyQt6.QtGui import (QDrag, QAction, QPixmap, QColor, QPainter, QPen, QFont)
-from PyQt6.QtCore import Qt, QSize, QRect, QPoint, QMimeData, QByteArray, QBuffer, QIODevice
+from PyQt6.QtGui import (QDrag, QAction, QPixmap, QColor, QPainter, QPen, QFont, QImage, QPolygonF,
+                         QKeySequence)
+from PyQt6.QtCore import (Qt, QSize, QRect, QPoint, QPointF, QMimeData, QByteArray, QBuffer, QIODevice,
+                          QEvent, QObject, QRunnable, QThreadPool, pyqtSignal, QUrl, QTimer)
+from PyQt6.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply, QNetworkDiskCache
 
 from setting_menus import SettingSize, SettingBackground, StyleSettingWindow, HelpWindow
-from highlighter import PythonSyntaxHighlighterInBlockCode, PythonSyntaxHighlighter
+from highlighter import PythonSyntaxHighlighterInBlockCode, CodeSyntaxHighlighter, languages, find_language
+from database import LazyBlob
 
-from urllib.request import Request, urlopen
-from sys import argv
+from collections import deque, Counter
+from sys import argv, getsizeof
+from array import array
+import struct
 import os
 
 
+# размер плитки холста для рисования
+TILE_SIZE = 256
+# размер клетки сетки для поиска элементов холста
+GRID_SIZE = 256
+# запас вокруг видимой области холста, в котором элементы тоже отображаются виджетами
+VIEWPORT_MARGIN = 512
+# время ожидания загрузки картинки по ссылке, мс
+FETCH_TIMEOUT = 15000
+# наибольший размер картинки, загружаемой по ссылке, байт
+FETCH_SIZE_LIMIT = 20 * 1024 * 1024
+# папка кэша картинок, загруженных по ссылке
+FETCH_CACHE = '.time_files/http_cache'
+FETCH_USER_AGENT = b'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:92.0) Gecko/20100101 Firefox/92.0'
+# начало содержимого холста, сохранённого плитками
+TILES_SIGNATURE = b'TILES1'
+# начало содержимого холста, сохранённого штрихами
+STROKES_SIGNATURE = b'PAINT2'
+TILE_HEADER = '<iiI'
+STROKE_HEADER = '<IfBI'
+# с какого количества штрихов плитки сохраняются вместе со штрихами
+RASTER_CACHE_STROKES = 200
+# сколько байт может занимать история отмены по умолчанию
+HISTORY_BUDGET = 16 * 1024 * 1024
+# примерный размер команды истории без содержимого, байт
+COMMAND_SIZE = 256
+# примерный размер точки штриха в памяти, байт
+POINT_SIZE = getsizeof(QPointF()) + 8
+
+
 def format_style(style: dict, style_sheet: str) -> str:
     '''Создать таблицу стилей'''
     for k, v in style.items():
@@ -19,17 +54,72 @@ def format_style(style: dict, style_sheet: str) -> str:
     return style_sheet
 
 
-class CodeLabel(QWidget):
+def read_content(content):
+    '''Получить содержимое элемента, загрузив его из базы данных, если оно ещё не загружено'''
+    if isinstance(content, LazyBlob):
+        return content.read()
+    return content
+
+
+class NoteElement:
+    """Отслеживание изменений элемента заметки для сохранения и истории отмены"""
+    # note_data_id элемента в базе данных, None - элемент ещё не сохранён
+    data_id = None
+    content_changed = True
+    saved_state = None
+    # положение и размер элемента при нажатии мыши
+    press_geometry = None
+
+    def set_content_changed(self, *args) -> None:
+        """Содержимое элемента изменилось"""
+        self.content_changed = True
+
+    def is_changed(self, layer: int) -> bool:
+        """Изменился ли элемент после последнего сохранения"""
+        return self.data_id is None or self.content_changed or self.saved_state != (layer, self.info(content=False))
+
+    def set_saved(self, layer: int) -> None:
+        """Элемент сохранён в базе данных на слое layer"""
+        self.content_changed = False
+        self.saved_state = (layer, self.info(content=False))
+
+    def type_name(self) -> str:
+        """Тип элемента в базе данных"""
+        return type(self).__name__
+
+    def start_geometry_change(self) -> None:
+        """Запомнить положение и размер перед перетаскиванием"""
+        self.press_geometry = QRect(self.geometry())
+
+    def finish_geometry_change(self, old: QRect | None = None) -> None:
+        """Записать изменение положения и размера в историю
+        old - положение и размер до изменения, по умолчанию запомненные при нажатии"""
+        old = self.press_geometry if old is None else old
+        self.press_geometry = None
+        if old is not None and old != self.geometry():
+            self.parent().history.push(GeometryCommand(self, old, QRect(self.geometry())))
+
+    def memory_size(self) -> int:
+        """Примерный объём памяти элемента в байтах"""
+        return COMMAND_SIZE
+
+    def read_content(self) -> None:
+        """Загрузить содержимое из базы данных, если оно ещё не загружено"""
+        pass
+
+
+class CodeLabel(QWidget, NoteElement):
     """Виджет размещения кода"""
-    def __init__(self, position_point: QPoint, *args, text=''):
+    def __init__(self, position_point: QPoint, *args, text='', language='Python'):
         super().__init__(*args)
         self.last_pos = QPoint()
         self.position_point = position_point
         # настрока и создание label
         self.setEnabled(False)
         self.label = NoteTextEdit(self)
-        self.highlighter = PythonSyntaxHighlighter(self.label.document())
+        self.highlighter = CodeSyntaxHighlighter(self.label.document(), self.label, language)
         self.label.setText(text)
+        self.label.textChanged.connect(self.set_content_changed)
         self.setMinimumSize(50, 50)
         self.label.setEnabled(False)
         self.setGeometry(QRect(position_point, self.label.sizeHint()))
@@ -43,6 +133,7 @@ class CodeLabel(QWidget):
         super().resize(e)
         
     def mouseReleaseEvent(self, e):
+        self.finish_geometry_change()
         # для активации label
         if self.isEnabled():
             if e.button() == Qt.MouseButton.LeftButton:
@@ -50,7 +141,7 @@ class CodeLabel(QWidget):
                 self.label.setFocus()
         else:
             self.setEnabled(True)
-            self.raise_()
+            self.parent().raise_element(self)
 
     def mouseMoveEvent(self, e):
         # для перетаскивания
@@ -82,6 +173,7 @@ class CodeLabel(QWidget):
 
     def mousePressEvent(self, e):
         self.last_pos = e.pos()
+        self.start_geometry_change()
 
     def keyPressEvent(self, e):
         if e.key() == 16777216:
@@ -96,10 +188,21 @@ class CodeLabel(QWidget):
         min_resize = menu.addAction('Уменьшить')
         resize = menu.addAction('Изменить размер')
         start = menu.addAction('Запустить код')
-        menu.addAction('Изменить язык')
+        language_menu = menu.addMenu('Изменить язык')
+        language_actions = {}
+        for name in languages:
+            language_action = language_menu.addAction(name)
+            language_action.setCheckable(True)
+            language_action.setChecked(name == self.highlighter.language.name)
+            language_actions[language_action] = name
         delete = menu.addAction('Удалить')
         action = menu.exec(self.mapToGlobal(e.pos()))
-        if action == move_back:
+        if action in language_actions:
+            if language_actions[action] != self.highlighter.language.name:
+                self.parent().history.push(LanguageCommand(self, self.highlighter.language.name,
+                                                           language_actions[action]))
+                self.set_args(language=language_actions[action])
+        elif action == move_back:
             self.parent().move_element_back(self)
         elif action == start:
             with open('.time_files/.code.py', 'w') as file:
@@ -108,13 +211,17 @@ class CodeLabel(QWidget):
         elif action == move_forward:
             self.parent().move_element_forward(self)
         elif action == min_resize:
+            geometry = QRect(self.geometry())
             self.resize(self.minimumSize())
             self.label.resize(self.minimumSize())
+            self.finish_geometry_change(geometry)
         elif action == resize:
             size_dialog = SettingSize(self.size())
             if size_dialog.exec():
+                geometry = QRect(self.geometry())
                 self.resize(size_dialog.get_size())
                 self.label.resize(self.size())
+                self.finish_geometry_change(geometry)
         elif action == delete:
             self.parent().delete_element(self)
 
@@ -123,15 +230,26 @@ class CodeLabel(QWidget):
         self.setEnabled(False)
         self.label.setEnabled(False)
 
-    def info(self) -> dict:
-        """Получение информации для сохранения"""
-        result = {'content': bytes(self.label.toPlainText(), encoding='utf-8'),
-                  'size': (self.size().width(), self.size().height()),
-                  'coords': self.geometry().getCoords()[:2]}
+    def memory_size(self) -> int:
+        """Примерный объём памяти элемента в байтах"""
+        return COMMAND_SIZE + len(self.label.toPlainText()) * 2
+
+    def set_args(self, language='Python'):
+        """Загрузка аргументов"""
+        self.highlighter.set_language(language)
+
+    def info(self, content: bool = True) -> dict:
+        """Получение информации для сохранения
+        content - добавить содержимое элемента"""
+        result = {'size': (self.size().width(), self.size().height()),
+                  'coords': self.geometry().getCoords()[:2],
+                  'args': str({'language': self.highlighter.language.name})}
+        if content:
+            result['content'] = bytes(self.label.toPlainText(), encoding='utf-8')
         return result
 
 
-class File(QLabel):
+class File(QLabel, NoteElement):
     """Виджет хранения файла"""
     def __init__(self, position_point: QPoint, *args, file=None):
         super().__init__(*args)
@@ -152,9 +270,10 @@ class File(QLabel):
         self.setGeometry(QRect(position_point, self.sizeHint()))
         
     def mouseReleaseEvent(self, e):
+        self.finish_geometry_change()
         # для активации
         self.setEnabled(True)
-        self.raise_()
+        self.parent().raise_element(self)
 
     def mouseMoveEvent(self, e):
         # для перетаскивания
@@ -169,6 +288,7 @@ class File(QLabel):
 
     def mousePressEvent(self, e):
         self.last_pos = e.pos()
+        self.start_geometry_change()
 
     def keyPressEvent(self, e):
         if e.key() == 16777216:
@@ -207,14 +327,18 @@ class File(QLabel):
     def open(self):
         """Для открытия файла"""
         with open('.time_files/' + self.name, 'wb') as file:
-            file.write(self.file)
+            if isinstance(self.file, LazyBlob):
+                for chunk in self.file.chunks():
+                    file.write(chunk)
+            else:
+                file.write(self.file)
         os.system('start .time_files/' + self.name)
 
     def convert_to_image(self):
         """Отобразить файл как изображение"""
         try:
             self.parent().add_image(self.pos(),
-                                    image=self.file)
+                                    image=read_content(self.file))
             self.parent().delete_element(self)
         except Exception:
             pass
@@ -222,7 +346,7 @@ class File(QLabel):
     def convert_to_text(self):
         """Отобразить файл как текстовую заметку"""
         try:
-            self.parent().add_note(self.pos(), text=self.file.decode('utf-8'))
+            self.parent().add_note(self.pos(), text=read_content(self.file).decode('utf-8'))
             self.parent().delete_element(self)
         except Exception:
             pass
@@ -230,14 +354,24 @@ class File(QLabel):
     def convert_to_code(self):
         """Отобразить файл как код"""
         try:
-            self.parent().add_code(self.pos(), text=self.file.decode('utf-8'))
+            language = find_language(os.path.splitext(self.name)[1][1:]) or 'Python'
+            self.parent().add_code(self.pos(), text=read_content(self.file).decode('utf-8'), language=language)
             self.parent().delete_element(self)
         except Exception:
             pass
 
+    def memory_size(self) -> int:
+        """Примерный объём памяти элемента в байтах"""
+        return COMMAND_SIZE + (len(self.file) if isinstance(self.file, bytes) else 0)
+
+    def read_content(self) -> None:
+        """Загрузить содержимое файла из базы данных, если оно ещё не загружено"""
+        self.file = read_content(self.file)
+
     def set_file(self, content_of_file: bytes):
         """Загрузка информации файла"""
         self.file = content_of_file
+        self.content_changed = True
 
     def set_args(self, name='file'):
         """Загрузка аргументов"""
@@ -245,18 +379,21 @@ class File(QLabel):
         self.setText(name)
         self.resize(QSize(self.sizeHint()))
 
-    def info(self) -> dict:
-        """Информация для сохранения"""
-        result = {'content': self.file,
-                  'size': (self.size().width(), self.size().height()),
+    def info(self, content: bool = True) -> dict:
+        """Информация для сохранения
+        content - добавить содержимое элемента"""
+        result = {'size': (self.size().width(), self.size().height()),
                   'coords': self.geometry().getCoords()[:2],
                   'args': str({"name": self.text()})}
+        if content:
+            result['content'] = read_content(self.file)
         return result
 
 
-class ImageLabel(QLabel):
-    """Виджет для размещения картинок"""
-    def __init__(self, point, *args, image=None, url=None):
+class ImageLabel(QLabel, NoteElement):
+    """Виджет для размещения картинок
+    decoded - картинка, уже разобранная в фоновом потоке, пустая QImage - картинка ещё загружается"""
+    def __init__(self, point, *args, image=None, url=None, decoded=None):
         super().__init__(*args)
         self.last_pos = QPoint(0, 0)
         self.enabled = True
@@ -267,9 +404,14 @@ class ImageLabel(QLabel):
         if url is not None:
             pixmap = QPixmap(url)
             self.image = url
+        elif decoded is not None:
+            pixmap = QPixmap.fromImage(decoded)
+            if image is not None:
+                self.image = image
         elif image is not None:
             pixmap = QPixmap()
-            pixmap.loadFromData(image)
+            # LazyBlob читается только для отображения и не хранится в памяти
+            pixmap.loadFromData(read_content(image))
             self.image = image
         self.label.setPixmap(pixmap) 
         self.setGeometry(QRect(point, self.label.sizeHint()))
@@ -284,11 +426,13 @@ class ImageLabel(QLabel):
         super().resize(e)
         
     def mouseReleaseEvent(self, e):
+        self.finish_geometry_change()
         self.setEnabled(True)
-        self.raise_()
+        self.parent().raise_element(self)
 
     def mousePressEvent(self, e):
         self.last_pos = e.pos()
+        self.start_geometry_change()
 
     def mouseMoveEvent(self, e):
         if e.buttons() == Qt.MouseButton.LeftButton:
@@ -329,14 +473,18 @@ class ImageLabel(QLabel):
             self.parent().move_element_back(self)
         elif action == move_forward:
             self.parent().move_element_forward(self)
-        elif action == min_resize:            
+        elif action == min_resize:
+            geometry = QRect(self.geometry())
             self.resize(self.minimumSize())
             self.label.resize(self.minimumSize())
+            self.finish_geometry_change(geometry)
         elif action == resize:
             size_dialog = SettingSize(self.size())
             if size_dialog.exec():
+                geometry = QRect(self.geometry())
                 self.resize(size_dialog.get_size())
                 self.label.resize(size_dialog.get_size())
+                self.finish_geometry_change(geometry)
         elif action == delete:
             self.parent().delete_element(self)
 
@@ -347,14 +495,40 @@ class ImageLabel(QLabel):
     def setEnabled(self, s):
         self.enabled = s
 
+    def set_image(self, image: QImage):
+        """Показать картинку, разобранную в фоновом потоке"""
+        self.label.setPixmap(QPixmap.fromImage(image))
+
+    def set_data(self, image: bytes) -> bool:
+        """Показать картинку, загруженную после создания виджета, False - данные не картинка"""
+        pixmap = QPixmap()
+        if not pixmap.loadFromData(image):
+            return False
+        self.image = image
+        self.label.setPixmap(pixmap)
+        self.resize(self.label.sizeHint())
+        self.content_changed = True
+        return True
+
+    def memory_size(self) -> int:
+        """Примерный объём памяти элемента в байтах"""
+        pixmap = self.label.pixmap()
+        return COMMAND_SIZE + pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def read_content(self) -> None:
+        """Загрузить картинку из базы данных, если она ещё не загружена"""
+        self.image = read_content(self.image)
+
     def isEnabled(self):
         return self.enabled
 
-    def info(self) -> dict:
-        """Информация для сохранения"""
-        result = {'content': self.image, 
-                  'size': (self.size().width(), self.size().height()),
+    def info(self, content: bool = True) -> dict:
+        """Информация для сохранения
+        content - добавить содержимое элемента"""
+        result = {'size': (self.size().width(), self.size().height()),
                   'coords': self.geometry().getCoords()[:2]}
+        if content:
+            result['content'] = read_content(self.image)
         return result
         
 
@@ -394,7 +568,7 @@ class NoteTextEdit(QTextEdit):
         super().mousePressEvent(e)
 
 
-class NoteLabel(QWidget):
+class NoteLabel(QWidget, NoteElement):
     """Виджет размещения текста"""
     def __init__(self, position_point: QPoint, *args, text=''):
         super().__init__(*args)
@@ -405,6 +579,7 @@ class NoteLabel(QWidget):
         self.label = NoteTextEdit(self)
         self.highlighter = PythonSyntaxHighlighterInBlockCode(self.label.document())
         self.label.setText(text)
+        self.label.textChanged.connect(self.set_content_changed)
         self.setMinimumSize(50, 50)
         self.label.setEnabled(False)
         self.setGeometry(QRect(position_point, self.label.sizeHint()))
@@ -418,6 +593,7 @@ class NoteLabel(QWidget):
         super().resize(e)
 
     def mouseReleaseEvent(self, e):
+        self.finish_geometry_change()
         # для активации label
         if self.isEnabled():
             if e.button() == Qt.MouseButton.LeftButton:
@@ -425,7 +601,7 @@ class NoteLabel(QWidget):
                 self.label.setFocus()
         else:
             self.setEnabled(True)
-            self.raise_()
+            self.parent().raise_element(self)
 
     def mouseMoveEvent(self, e):
         # для перетаскивания
@@ -457,6 +633,7 @@ class NoteLabel(QWidget):
 
     def mousePressEvent(self, e):
         self.last_pos = e.pos()
+        self.start_geometry_change()
 
     def keyPressEvent(self, e):
         if e.key() == 16777216:
@@ -477,13 +654,17 @@ class NoteLabel(QWidget):
         elif action == move_forward:
             self.parent().move_element_forward(self)
         elif action == min_resize:
+            geometry = QRect(self.geometry())
             self.resize(self.minimumSize())
             self.label.resize(self.minimumSize())
+            self.finish_geometry_change(geometry)
         elif action == resize:
             size_dialog = SettingSize(self.size())
             if size_dialog.exec():
+                geometry = QRect(self.geometry())
                 self.resize(size_dialog.get_size())
                 self.label.resize(self.size())
+                self.finish_geometry_change(geometry)
         elif action == delete:
             self.parent().delete_element(self)
 
@@ -492,14 +673,347 @@ class NoteLabel(QWidget):
         self.setEnabled(False)
         self.label.setEnabled(False)
 
-    def info(self) -> dict:
-        """Получения информации для сохранения"""
-        result = {'content': bytes(self.label.toPlainText(), encoding='utf-8'),
-                  'size': (self.size().width(), self.size().height()),
+    def memory_size(self) -> int:
+        """Примерный объём памяти элемента в байтах"""
+        return COMMAND_SIZE + len(self.label.toPlainText()) * 2
+
+    def info(self, content: bool = True) -> dict:
+        """Получения информации для сохранения
+        content - добавить содержимое элемента"""
+        result = {'size': (self.size().width(), self.size().height()),
                   'coords': self.geometry().getCoords()[:2]}
+        if content:
+            result['content'] = bytes(self.label.toPlainText(), encoding='utf-8')
         return result
 
-            
+
+
+class ElementRecord(NoteElement):
+    """Лёгкая запись элемента заметки вне видимой области холста,
+    виджет для неё создаётся, когда элемент попадает в видимую область
+    content - содержимое как в базе данных, args - аргументы как в базе данных"""
+    def __init__(self, type_name: str, rect: QRect, content, args: str = ''):
+        self.element_type = type_name
+        self.rect = QRect(rect)
+        self.content = content
+        self.args = args
+
+    def type_name(self) -> str:
+        return self.element_type
+
+    def geometry(self) -> QRect:
+        return QRect(self.rect)
+
+    def disable(self):
+        pass
+
+    def memory_size(self) -> int:
+        """Примерный объём памяти записи в байтах"""
+        return COMMAND_SIZE + (len(self.content) if isinstance(self.content, bytes) else 0)
+
+    def info(self, content: bool = True) -> dict:
+        """Информация для сохранения
+        content - добавить содержимое элемента"""
+        result = {'size': (self.rect.width(), self.rect.height()),
+                  'coords': (self.rect.x(), self.rect.y())}
+        if self.args:
+            result['args'] = self.args
+        if content:
+            result['content'] = read_content(self.content)
+        return result
+
+
+class GridIndex:
+    """Сетка для поиска элементов холста по точке
+    элемент записывается во все клетки GRID_SIZE x GRID_SIZE, которые он пересекает"""
+    def __init__(self, size: int = GRID_SIZE):
+        self.size = size
+        # (столбец, строка) -> элементы клетки
+        self.cells = {}
+        # элемент -> QRect
+        self.rects = {}
+
+    def cells_in_rect(self, rect: QRect):
+        """Клетки, пересекающиеся с rect"""
+        for column in range(rect.left() // self.size, rect.right() // self.size + 1):
+            for row in range(rect.top() // self.size, rect.bottom() // self.size + 1):
+                yield column, row
+
+    def insert(self, element, rect: QRect) -> None:
+        """Добавить элемент с прямоугольником rect"""
+        self.rects[element] = QRect(rect)
+        for key in self.cells_in_rect(rect):
+            self.cells.setdefault(key, set()).add(element)
+
+    def remove(self, element) -> None:
+        """Убрать элемент"""
+        rect = self.rects.pop(element, None)
+        if rect is None:
+            return
+        for key in self.cells_in_rect(rect):
+            cell = self.cells[key]
+            cell.discard(element)
+            if not cell:
+                del self.cells[key]
+
+    def update(self, element, rect: QRect) -> None:
+        """Перенести элемент в новый прямоугольник"""
+        if self.rects.get(element) != rect:
+            self.remove(element)
+            self.insert(element, rect)
+
+    def at(self, point: QPoint) -> list:
+        """Элементы, содержащие точку point"""
+        cell = self.cells.get((point.x() // self.size, point.y() // self.size), ())
+        return [element for element in cell if self.rects[element].contains(point)]
+
+    def in_rect(self, rect: QRect) -> set:
+        """Элементы, пересекающиеся с rect"""
+        result = set()
+        for key in self.cells_in_rect(rect):
+            result.update(element for element in self.cells.get(key, ()) if self.rects[element].intersects(rect))
+        return result
+
+
+class History:
+    """История изменений холста для отмены и повтора
+    budget - сколько байт может занимать история, самые старые команды забываются"""
+    def __init__(self, budget: int = HISTORY_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.undo_commands = deque()
+        self.redo_commands = deque()
+        # во время отмены и повтора новые команды не записываются
+        self.locked = False
+        # сколько команд ссылается на каждый элемент
+        self.elements = Counter()
+
+    def push(self, command) -> None:
+        """Записать выполненную команду"""
+        if self.locked:
+            return
+        self.drop(self.redo_commands)
+        self.undo_commands.append(command)
+        self.size += command.size
+        self.elements[getattr(command, 'element', None)] += 1
+        while self.size > self.budget and self.undo_commands:
+            self.forget(self.undo_commands.popleft())
+
+    def undo(self) -> bool:
+        """Отменить последнюю команду"""
+        if not self.undo_commands:
+            return False
+        command = self.undo_commands.pop()
+        self.locked = True
+        try:
+            command.undo()
+        finally:
+            self.locked = False
+        self.redo_commands.append(command)
+        return True
+
+    def redo(self) -> bool:
+        """Повторить последнюю отменённую команду"""
+        if not self.redo_commands:
+            return False
+        command = self.redo_commands.pop()
+        self.locked = True
+        try:
+            command.redo()
+        finally:
+            self.locked = False
+        self.undo_commands.append(command)
+        return True
+
+    def forget(self, command) -> None:
+        """Забыть команду"""
+        self.size -= command.size
+        element = getattr(command, 'element', None)
+        self.elements[element] -= 1
+        if not self.elements[element]:
+            del self.elements[element]
+        command.discard()
+
+    def drop(self, commands: deque) -> None:
+        """Забыть команды"""
+        while commands:
+            self.forget(commands.pop())
+
+    def references(self, element) -> bool:
+        """Ссылаются ли команды истории на элемент"""
+        return element in self.elements
+
+    def clear(self) -> None:
+        """Очистить историю"""
+        self.drop(self.redo_commands)
+        self.drop(self.undo_commands)
+
+
+class ElementCommand:
+    """Добавление (added=True) или удаление элемента на слое index"""
+    def __init__(self, canvas, element, index: int, added: bool):
+        self.canvas = canvas
+        self.element = element
+        self.index = index
+        self.added = added
+        self.done = True
+        # удалённый элемент хранится в истории целиком
+        self.size = COMMAND_SIZE if added else element.memory_size()
+
+    def undo(self) -> None:
+        if self.added:
+            self.canvas.remove_element(self.element)
+        else:
+            self.canvas.restore_element(self.element, self.index)
+        self.done = False
+
+    def redo(self) -> None:
+        if self.added:
+            self.canvas.restore_element(self.element, self.index)
+        else:
+            self.canvas.remove_element(self.element)
+        self.done = True
+
+    def discard(self) -> None:
+        # виджет удаляется, только если он убран с холста и вернуть его больше нельзя
+        if self.done != self.added:
+            self.element.deleteLater()
+
+
+class GeometryCommand:
+    """Перемещение или изменение размера элемента"""
+    def __init__(self, element, old: QRect, new: QRect):
+        self.element = element
+        self.old = old
+        self.new = new
+        self.size = COMMAND_SIZE
+
+    def undo(self) -> None:
+        self.element.setGeometry(self.old)
+
+    def redo(self) -> None:
+        self.element.setGeometry(self.new)
+
+    def discard(self) -> None:
+        pass
+
+
+class LanguageCommand:
+    """Смена языка блока кода"""
+    def __init__(self, element, old: str, new: str):
+        self.element = element
+        self.old = old
+        self.new = new
+        self.size = COMMAND_SIZE
+
+    def undo(self) -> None:
+        self.element.set_args(language=self.old)
+
+    def redo(self) -> None:
+        self.element.set_args(language=self.new)
+
+    def discard(self) -> None:
+        pass
+
+
+class LayerCommand:
+    """Перемещение элемента на слой назад (forward=False) или вперёд"""
+    def __init__(self, canvas, element, forward: bool):
+        self.canvas = canvas
+        self.element = element
+        self.forward = forward
+        self.size = COMMAND_SIZE
+
+    def undo(self) -> None:
+        if self.forward:
+            self.canvas.move_element_back(self.element)
+        else:
+            self.canvas.move_element_forward(self.element)
+
+    def redo(self) -> None:
+        if self.forward:
+            self.canvas.move_element_forward(self.element)
+        else:
+            self.canvas.move_element_back(self.element)
+
+    def discard(self) -> None:
+        pass
+
+
+class StrokeCommand:
+    """Штрих на холсте для рисования, хранятся только точки штриха"""
+    def __init__(self, paint_canvas, stroke):
+        self.paint_canvas = paint_canvas
+        self.stroke = stroke
+        self.size = COMMAND_SIZE + len(stroke.points) * POINT_SIZE
+
+    def undo(self) -> None:
+        self.paint_canvas.remove_stroke(self.stroke)
+
+    def redo(self) -> None:
+        self.paint_canvas.add_stroke(self.stroke)
+
+    def discard(self) -> None:
+        pass
+
+
+class ImageFetcher(QObject):
+    """Загрузка картинок по ссылке без остановки интерфейса
+    ответы хранятся в кэше на диске по ссылке, поэтому повторная загрузка той же картинки мгновенная
+    cache_directory - папка кэша, по умолчанию FETCH_CACHE"""
+    def __init__(self, canvas, cache_directory: str | None = None, timeout: int = FETCH_TIMEOUT,
+                 size_limit: int = FETCH_SIZE_LIMIT):
+        super().__init__(canvas)
+        self.canvas = canvas
+        self.timeout = timeout
+        self.size_limit = size_limit
+        self.manager = QNetworkAccessManager(self)
+        cache = QNetworkDiskCache(self)
+        cache.setCacheDirectory(cache_directory or FETCH_CACHE)
+        self.manager.setCache(cache)
+        # заглушка ImageLabel -> ответ, который в неё загружается
+        self.replies = {}
+
+    def fetch(self, url: QUrl, placeholder) -> None:
+        """Загрузить картинку в заглушку, по окончании вызывается canvas.image_fetched"""
+        request = QNetworkRequest(url)
+        request.setRawHeader(b'User-Agent', FETCH_USER_AGENT)
+        request.setAttribute(QNetworkRequest.Attribute.CacheLoadControlAttribute,
+                             QNetworkRequest.CacheLoadControl.PreferCache)
+        request.setTransferTimeout(self.timeout)
+        reply = self.manager.get(request)
+        self.replies[placeholder] = reply
+        reply.downloadProgress.connect(lambda received, total: self.check_size(reply, received, total))
+        reply.finished.connect(lambda: self.finish(placeholder, reply))
+
+    def check_size(self, reply: QNetworkReply, received: int, total: int) -> None:
+        """Прервать загрузку больше size_limit байт"""
+        if max(received, total) > self.size_limit:
+            reply.abort()
+
+    def finish(self, placeholder, reply: QNetworkReply) -> None:
+        data = None
+        if reply.error() == QNetworkReply.NetworkError.NoError:
+            data = reply.readAll().data()
+        reply.deleteLater()
+        # отменённая загрузка уже убрана из replies
+        if self.replies.pop(placeholder, None) is not None:
+            self.canvas.image_fetched(placeholder, data)
+
+    def cancel(self, placeholder) -> None:
+        """Отменить загрузку в заглушку"""
+        reply = self.replies.pop(placeholder, None)
+        if reply is not None:
+            reply.abort()
+
+    def cancel_all(self) -> None:
+        """Отменить все загрузки и убрать их заглушки с холста"""
+        for placeholder in list(self.replies):
+            self.cancel(placeholder)
+            self.canvas.remove_element(placeholder)
+            placeholder.deleteLater()
+
+
 class Canvas(QWidget):
     """Главный холст
     paint_canvas - холст для рисования"""
@@ -508,6 +1022,28 @@ class Canvas(QWidget):
         self.parent = self.parent()
         self.layout = []
         self.items = {}
+        # note_data_id удалённых элементов до сохранения
+        self.deleted_ids = []
+        # история отмены и повтора
+        self.history = History()
+        # сетка для поиска элементов по точке
+        self.grid = GridIndex()
+        # активные элементы, поднятые над остальными
+        self.active = set()
+        # количество операций с виджетами для замеров
+        self.widget_operations = Counter()
+        # виджеты текстовых полей, убранные из видимой области, для повторного использования
+        self.pool = {'NoteLabel': [], 'CodeLabel': []}
+        # загрузка картинок по ссылке
+        self.fetcher = ImageFetcher(self)
+        # картинки разбираются в фоновых потоках, когда элемент становится виджетом
+        self.decode_in_background = False
+        # картинки, которые сейчас разбираются: note_data_id -> ImageLabel
+        self.decoding = {}
+        # картинки, разбор которых ещё не запущен
+        self.decode_queue = []
+        self.decoder_signals = NoteLoaderSignals(self)
+        self.decoder_signals.image_decoded.connect(self.set_decoded_image)
         self.add_notes_mode = False
         self.add_files_mode = False
         self.add_codes_mode = False
@@ -532,11 +1068,113 @@ class Canvas(QWidget):
         elif self.add_codes_mode:
             self.add_code(e.pos())
         elif not self.paint_canvas.drawing_mode:
-            for k in self.layout:
-                if k != self.paint_canvas:
-                    if e.pos() in self.items[k]():
-                        self.do_layout()
-                        k.mouseReleaseEvent(e)
+            found = [k for k in self.grid.at(e.pos()) if not isinstance(k, ElementRecord)]
+            if len(found) > 1:
+                found.sort(key=self.layout.index)
+            for k in found:
+                self.do_layout()
+                k.mouseReleaseEvent(e)
+
+    def eventFilter(self, obj, e):
+        # перемещённый или изменивший размер элемент переносится в сетке
+        if e.type() in (QEvent.Type.Move, QEvent.Type.Resize) and obj in self.items:
+            self.grid.update(obj, obj.geometry())
+        return super().eventFilter(obj, e)
+
+    def track_element(self, element):
+        """Начать отслеживать положение элемента"""
+        self.grid.insert(element, element.geometry())
+        if not isinstance(element, ElementRecord):
+            self.items[element] = element.geometry
+            element.installEventFilter(self)
+
+    def untrack_element(self, element):
+        """Перестать отслеживать положение элемента"""
+        self.grid.remove(element)
+        if not isinstance(element, ElementRecord):
+            element.removeEventFilter(self)
+            del self.items[element]
+
+    def add_record(self, type_name: str, rect: QRect, content, args: str = '') -> ElementRecord:
+        """Добавить элемент записью, виджет создаётся в update_viewport"""
+        record = ElementRecord(type_name, rect, content, args)
+        self.layout.append(record)
+        self.track_element(record)
+        return record
+
+    def update_viewport(self, rect: QRect):
+        """Создать виджеты элементов, видимых в rect, и убрать виджеты далеко за его пределами"""
+        rect = rect.adjusted(-VIEWPORT_MARGIN, -VIEWPORT_MARGIN, VIEWPORT_MARGIN, VIEWPORT_MARGIN)
+        visible = self.grid.in_rect(rect)
+        for element in list(self.items):
+            if (element not in visible and element not in self.active and not self.history.references(element)
+               and element not in self.fetcher.replies and element.type_name() in ('NoteLabel', 'CodeLabel', 'ImageLabel', 'File')):
+                self.dematerialize(element)
+        for element in visible:
+            if isinstance(element, ElementRecord):
+                self.materialize(element)
+
+    def materialize(self, record: ElementRecord):
+        """Заменить запись виджетом"""
+        type_name = record.type_name()
+        position = record.rect.topLeft()
+        if type_name in self.pool and self.pool[type_name]:
+            element = self.pool[type_name].pop()
+            if type_name == 'CodeLabel':
+                # у блоков кода, сохранённых до выбора языка, аргументов нет
+                element.set_args(**eval(record.args or '{}'))
+            element.label.setText(record.content.decode('utf-8'))
+        elif type_name == 'NoteLabel':
+            element = NoteLabel(position, self, text=record.content.decode('utf-8'))
+        elif type_name == 'CodeLabel':
+            element = CodeLabel(position, self, text=record.content.decode('utf-8'), **eval(record.args or '{}'))
+        elif type_name == 'ImageLabel' and self.decode_in_background and record.data_id is not None:
+            # до разбора картинки на её месте пустой виджет
+            element = ImageLabel(position, self, image=record.content, decoded=QImage())
+            self.decoding[record.data_id] = element
+            if not self.decode_queue:
+                QTimer.singleShot(0, self.start_decoding)
+            self.decode_queue.append((record.data_id, record.content))
+        elif type_name == 'ImageLabel':
+            element = ImageLabel(position, self, image=record.content)
+        else:
+            element = File(position, self, file='')
+            element.set_file(record.content)
+            element.set_args(**eval(record.args))
+        element.setGeometry(record.rect)
+        element.data_id = record.data_id
+        if record.saved_state is not None and not record.is_changed(record.saved_state[0]):
+            element.set_saved(record.saved_state[0])
+        else:
+            element.content_changed = record.content_changed
+            element.saved_state = record.saved_state
+        self.untrack_element(record)
+        self.layout[self.layout.index(record)] = element
+        self.track_element(element)
+        element.show()
+        self.restack(element)
+
+    def dematerialize(self, element):
+        """Заменить виджет лёгкой записью"""
+        type_name = element.type_name()
+        if type_name in ('NoteLabel', 'CodeLabel'):
+            content = bytes(element.label.toPlainText(), encoding='utf-8')
+        elif type_name == 'ImageLabel':
+            content = element.image
+        else:
+            content = element.file
+        record = ElementRecord(type_name, element.geometry(), content, element.info(content=False).get('args', ''))
+        record.data_id = element.data_id
+        record.content_changed = element.content_changed
+        record.saved_state = element.saved_state
+        self.untrack_element(element)
+        self.layout[self.layout.index(element)] = record
+        self.track_element(record)
+        element.hide()
+        if type_name in self.pool:
+            self.pool[type_name].append(element)
+        else:
+            element.deleteLater()
 
     def dragEnterEvent(self, e):
         e.accept()
@@ -554,15 +1192,7 @@ class Canvas(QWidget):
                 self.add_file(QPoint(int(e.position().x()), int(e.position().y())),
                               file=url.toLocalFile())
             else:
-                try:
-                    request_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:92.0)\
-Gecko/20100101 Firefox/92.0'}
-                    req = Request(url.toString(), headers=request_headers)
-                    data = urlopen(req).read()
-                except Exception:
-                    return
-                self.add_image(QPoint(int(e.position().x()), int(e.position().y())),
-                               image=data)
+                self.add_remote_image(QPoint(int(e.position().x()), int(e.position().y())), url)
         elif e.mimeData().parent().is_text:
             self.add_note(e.position().toPoint(),
                           text=e.mimeData().text())
@@ -571,13 +1201,32 @@ Gecko/20100101 Firefox/92.0'}
                           text=e.mimeData().text())
 
     def do_layout(self):
-        """Отображение элементов заметок по слоям"""
-        for i in self.layout:
-            i.disable()
-            i.show()
-            i.raise_()
+        """Вернуть активные элементы на их слои и снять с них фокус,
+        остальные элементы уже стоят по слоям и не трогаются"""
+        # сверху вниз, чтобы элемент выше уже стоял на своём месте
+        for element in sorted(self.active, key=self.layout.index, reverse=True):
+            element.disable()
+            self.widget_operations['disable'] += 1
+            self.restack(element)
+        self.active = set()
         self.setFocus()
 
+    def restack(self, element):
+        """Поставить элемент на его слой, под ближайший виджет выше него"""
+        for index in range(self.layout.index(element) + 1, len(self.layout)):
+            if not isinstance(self.layout[index], ElementRecord):
+                element.stackUnder(self.layout[index])
+                self.widget_operations['stackUnder'] += 1
+                return
+        element.raise_()
+        self.widget_operations['raise_'] += 1
+
+    def raise_element(self, element):
+        """Поднять активный элемент над остальными до следующего do_layout"""
+        element.raise_()
+        self.widget_operations['raise_'] += 1
+        self.active.add(element)
+
     def set_add_notes_mode(self, add_notes_mode: bool):
         """Режим добавления заметок"""
         self.add_notes_mode = add_notes_mode
@@ -594,29 +1243,53 @@ Gecko/20100101 Firefox/92.0'}
         """Создание поля для текстовой заметки"""
         new_label = NoteLabel(pos, self, text=text)
         new_label.show()
-        self.items[new_label] = new_label.geometry
+        self.track_element(new_label)
         self.layout.append(new_label)
         self.do_layout()
+        self.history.push(ElementCommand(self, new_label, len(self.layout) - 1, added=True))
         return new_label
 
-    def add_code(self, pos: QPoint(), text='') -> CodeLabel:
+    def add_code(self, pos: QPoint(), text='', language='Python') -> CodeLabel:
         """Создание поля для кода"""
-        new_label = CodeLabel(pos, self, text=text)
+        new_label = CodeLabel(pos, self, text=text, language=language)
         new_label.show()
-        self.items[new_label] = new_label.geometry
+        self.track_element(new_label)
         self.layout.append(new_label)
         self.do_layout()
+        self.history.push(ElementCommand(self, new_label, len(self.layout) - 1, added=True))
         return new_label
 
-    def add_image(self, pos, image=None, url=None) -> ImageLabel:
+    def add_image(self, pos, image=None, url=None, decoded=None) -> ImageLabel:
         """Создание картинки"""
-        lb = ImageLabel(pos, self, image=image, url=url)
+        lb = ImageLabel(pos, self, image=image, url=url, decoded=decoded)
         lb.show()
         self.layout.append(lb)
-        self.items[lb] = lb.geometry
+        self.track_element(lb)
         self.do_layout()
+        self.history.push(ElementCommand(self, lb, len(self.layout) - 1, added=True))
         return lb
 
+    def add_remote_image(self, pos, url: QUrl) -> ImageLabel:
+        """Создание картинки по ссылке: сначала заглушка, картинка загружается в фоне"""
+        # в историю добавление попадёт, когда картинка загрузится
+        self.history.locked = True
+        try:
+            placeholder = self.add_image(pos, decoded=QImage())
+        finally:
+            self.history.locked = False
+        placeholder.label.setText('Загрузка...')
+        placeholder.resize(placeholder.label.sizeHint())
+        self.fetcher.fetch(url, placeholder)
+        return placeholder
+
+    def image_fetched(self, placeholder: ImageLabel, data: bytes | None):
+        """Картинка по ссылке загружена, None - загрузка не удалась"""
+        if data is None or not placeholder.set_data(data):
+            self.remove_element(placeholder)
+            placeholder.deleteLater()
+        else:
+            self.history.push(ElementCommand(self, placeholder, self.layout.index(placeholder), added=True))
+
     def add_file(self, pos, file=None) -> File:
         """Создание файла"""
         if file is None:
@@ -628,8 +1301,9 @@ Gecko/20100101 Firefox/92.0'}
         f = File(pos, self, file=file)
         f.show()
         self.layout.append(f)
-        self.items[f] = f.geometry
+        self.track_element(f)
         self.do_layout()
+        self.history.push(ElementCommand(self, f, len(self.layout) - 1, added=True))
         return f
         
     def move_element_back(self, element):
@@ -637,34 +1311,93 @@ Gecko/20100101 Firefox/92.0'}
         index = self.layout.index(element)
         if index - 1 >= 0:
             self.layout[index - 1], self.layout[index] = self.layout[index], self.layout[index - 1]
+            self.restack(element)
             self.do_layout()
+            self.history.push(LayerCommand(self, element, forward=False))
 
     def move_element_forward(self, element):
         """Переместить элемент на передний фон"""
         index = self.layout.index(element)
         if index + 1 < len(self.layout):
             self.layout[index + 1], self.layout[index] = self.layout[index], self.layout[index + 1]
+            self.restack(element)
             self.do_layout()
+            self.history.push(LayerCommand(self, element, forward=True))
         
     def delete_element(self, element):
         """Удалить элемент с холста"""
-        print(self.items)
-        element.deleteLater()
+        if element in self.fetcher.replies:
+            # картинка ещё загружается, пустая заглушка в историю не попадает
+            self.remove_element(element)
+            element.deleteLater()
+            return
+        # после сохранения удаления blob элемента удаляется из базы данных, а элемент остаётся в истории
+        element.read_content()
+        self.history.push(ElementCommand(self, element, self.layout.index(element), added=False))
+        self.remove_element(element)
+
+    def remove_element(self, element):
+        """Убрать элемент с холста, не удаляя виджет, чтобы его можно было вернуть"""
+        self.fetcher.cancel(element)
+        if element.data_id is not None:
+            self.deleted_ids.append(element.data_id)
+        element.disable()
+        element.hide()
+        self.active.discard(element)
         self.layout.remove(element)
-        del self.items[element]
+        self.untrack_element(element)
         self.do_layout()
 
+    def restore_element(self, element, index: int):
+        """Вернуть убранный элемент на слой index"""
+        if element.data_id in self.deleted_ids:
+            self.deleted_ids.remove(element.data_id)
+        elif element.data_id is not None:
+            # удаление уже сохранено, элемент будет добавлен заново
+            element.data_id = None
+        self.layout.insert(index, element)
+        self.track_element(element)
+        element.show()
+        self.restack(element)
+        self.do_layout()
+
+    def undo(self):
+        """Отменить последнее изменение"""
+        self.paint_canvas.finish_stroke()
+        self.history.undo()
+
+    def redo(self):
+        """Повторить отменённое изменение"""
+        self.paint_canvas.finish_stroke()
+        self.history.redo()
+
     def keyPressEvent(self, e):
         # esc
         if e.key() == 16777216:
             self.do_layout()
             self.parent.set_cursor()
 
-    def set_paint_canvas(self, content):
-        '''Установить холст рисования'''
+    def set_paint_canvas(self, content=None):
+        '''Установить холст рисования, None - рисунок загрузится позже'''
         del self.layout[0]
-        self.paint_canvas.set_content(content)
+        if content is not None:
+            self.paint_canvas.set_content(content)
         self.layout.append(self.paint_canvas)
+        self.restack(self.paint_canvas)
+
+    def start_decoding(self):
+        """Запустить разбор картинок из очереди
+        разбор запускается после показа текста: PyQt держит GIL, пока разбирает картинку"""
+        for data_id, content in self.decode_queue:
+            QThreadPool.globalInstance().start(ImageDecoder(data_id, content, self.decoder_signals))
+        self.decode_queue = []
+
+    def set_decoded_image(self, data_id: int, image: QImage):
+        """Показать картинку элемента data_id, разобранную в фоновом потоке
+        если виджет уже убран из видимой области, картинка разберётся заново при его показе"""
+        element = self.decoding.pop(data_id, None)
+        if element is not None and element in self.items:
+            element.set_image(image)
 
     def set_args(self, fone=None, size=None):
         '''Установить дополнительные настройки'''
@@ -676,58 +1409,273 @@ Gecko/20100101 Firefox/92.0'}
             self.paint_canvas.resize(QSize(*size))
         
     
-class PaintCanvas(QLabel):
-    """Холст для рисования"""
+class Stroke:
+    """Штрих кисти или ластика
+    color - цвет в формате ARGB, width - толщина, erase - штрих ластика, points - точки штриха"""
+    def __init__(self, color: int, width: float, erase: bool = False, points: list | None = None):
+        self.color = color
+        self.width = width
+        self.erase = erase
+        self.points = points if points is not None else []
+
+    def bounding_rect(self, start: int = 0) -> QRect:
+        """Прямоугольник, который закрашивает штрих, начиная с точки start"""
+        # отрезок кисти начинается в предыдущей точке
+        polygon = QPolygonF(self.points[start if self.erase else max(start - 1, 0):])
+        width = int(self.width) + 1
+        return polygon.boundingRect().toAlignedRect().adjusted(-width, -width, width, width)
+
+    def paint(self, painter: QPainter, start: int = 0) -> None:
+        """Нарисовать штрих, начиная с точки start
+        при рисовании мышью каждая новая точка рисуется так же, поэтому загруженный штрих совпадает с нарисованным"""
+        if self.erase:
+            # ластик стирает квадрат толщиной width в каждой точке
+            width = int(self.width)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear)
+            for point in self.points[start:]:
+                painter.eraseRect(QRect(point.toPoint() - QPoint(width // 2, width // 2), QSize(width, width)))
+        else:
+            painter.setPen(QPen(QColor.fromRgba(self.color), self.width, Qt.PenStyle.SolidLine,
+                                Qt.PenCapStyle.RoundCap, Qt.PenJoinStyle.RoundJoin))
+            # отрезки рисуются по одному, как при рисовании мышью
+            for i in range(max(start, 1), len(self.points)):
+                painter.drawLine(self.points[i - 1], self.points[i])
+
+    def to_bytes(self) -> bytes:
+        """Упаковать штрих для сохранения"""
+        points = array('f', [coordinate for point in self.points for coordinate in (point.x(), point.y())])
+        return struct.pack(STROKE_HEADER, self.color, self.width, self.erase, len(self.points)) + points.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, offset: int = 0) -> tuple:
+        """Распаковать штрих, возвращает штрих и смещение после него"""
+        color, width, erase, count = struct.unpack_from(STROKE_HEADER, data, offset)
+        offset += struct.calcsize(STROKE_HEADER)
+        points = array('f')
+        points.frombytes(data[offset:offset + count * 8])
+        offset += count * 8
+        return cls(color, width, bool(erase), [QPointF(points[i], points[i + 1]) for i in range(0, len(points), 2)]), offset
+
+
+def pack_tiles(tiles: dict) -> bytes:
+    '''Упаковать плитки {(столбец, строка): PNG} для сохранения'''
+    return b''.join(struct.pack(TILE_HEADER, column, row, len(png)) + png for (column, row), png in tiles.items())
+
+
+def unpack_tiles(data: bytes, offset: int, count: int | None = None) -> tuple:
+    '''Распаковать count плиток (None - до конца data), возвращает {(столбец, строка): PNG} и смещение после них'''
+    tiles = {}
+    while len(tiles) != count and offset < len(data):
+        column, row, length = struct.unpack_from(TILE_HEADER, data, offset)
+        offset += struct.calcsize(TILE_HEADER)
+        tiles[column, row] = data[offset:offset + length]
+        offset += length
+    return tiles, offset
+
+
+def encode_image(image: QImage) -> bytes:
+    '''Закодировать изображение в PNG'''
+    ba = QByteArray()
+    buff = QBuffer(ba)
+    buff.open(QIODevice.OpenModeFlag.WriteOnly)
+    image.save(buff, "PNG")
+    return ba.data()
+
+
+class PaintLayers:
+    """Плитки и штрихи рисунка без виджета, разбирать рисунок можно не в главном потоке
+    update вызывается после изменения плиток, у PaintCanvas это QWidget.update"""
+    def init_layers(self) -> None:
+        # плитки рисунка: (столбец, строка) -> QImage
+        self.tiles = {}
+        # плитки в формате PNG, не изменявшиеся после кодирования
+        self.encoded_tiles = {}
+        # растровый рисунок из старых заметок в формате PNG, поверх него рисуются штрихи
+        self.base_tiles = {}
+        # штрихи по порядку
+        self.strokes = []
+
+    def update(self, *args) -> None:
+        pass
+
+    def tiles_in_rect(self, rect: QRect, create: bool = False, only=None):
+        """Плитки, пересекающиеся с rect, в формате (столбец, строка), QImage
+        create - создать недостающие плитки, only - перебирать только плитки из only"""
+        for column in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1):
+            for row in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1):
+                if only is not None and (column, row) not in only:
+                    continue
+                if (column, row) not in self.tiles:
+                    if not create or column < 0 or row < 0:
+                        continue
+                    tile = QImage(TILE_SIZE, TILE_SIZE, QImage.Format.Format_ARGB32_Premultiplied)
+                    tile.fill(Qt.GlobalColor.transparent)
+                    self.tiles[column, row] = tile
+                # плитка изменится, старый PNG больше не подходит
+                self.encoded_tiles.pop((column, row), None)
+                yield (column, row), self.tiles[column, row]
+
+    def paint_on_tiles(self, rect: QRect, paint, create: bool = True, only=None) -> None:
+        """Вызвать paint(painter) для каждой плитки, пересекающейся с rect, в координатах холста"""
+        for (column, row), tile in self.tiles_in_rect(rect, create, only):
+            painter = QPainter(tile)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            painter.translate(-column * TILE_SIZE, -row * TILE_SIZE)
+            paint(painter)
+            painter.end()
+        self.content_changed = True
+        # перерисовать только изменившуюся область
+        self.update(rect)
+
+    def render_tiles(self, keys, strokes: list | None = None) -> None:
+        """Перерисовать плитки keys заново из растрового рисунка и штрихов strokes (по умолчанию всех)"""
+        keys = set(keys)
+        for key in keys:
+            self.tiles.pop(key, None)
+            self.encoded_tiles.pop(key, None)
+            if key in self.base_tiles:
+                self.tiles[key] = QImage.fromData(self.base_tiles[key]).convertToFormat(
+                    QImage.Format.Format_ARGB32_Premultiplied)
+        for stroke in self.strokes if strokes is None else strokes:
+            self.paint_on_tiles(stroke.bounding_rect(), stroke.paint, create=not stroke.erase, only=keys)
+
+    def set_content(self, content):
+        """Загрузка рисунка: штрихи, плитки или одно изображение PNG из старых заметок"""
+        self.tiles = {}
+        self.encoded_tiles = {}
+        self.base_tiles = {}
+        self.strokes = []
+        cache = {}
+        baked = 0
+        if content.startswith(STROKES_SIGNATURE):
+            offset = len(STROKES_SIGNATURE)
+            base_count, cache_count, baked, strokes_count = struct.unpack_from('<IIII', content, offset)
+            offset += struct.calcsize('<IIII')
+            self.base_tiles, offset = unpack_tiles(content, offset, base_count)
+            cache, offset = unpack_tiles(content, offset, cache_count)
+            for _ in range(strokes_count):
+                stroke, offset = Stroke.from_bytes(content, offset)
+                self.strokes.append(stroke)
+        elif content.startswith(TILES_SIGNATURE):
+            self.base_tiles, _ = unpack_tiles(content, len(TILES_SIGNATURE))
+        else:
+            image = QImage.fromData(content).convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+            for column in range((image.width() + TILE_SIZE - 1) // TILE_SIZE):
+                for row in range((image.height() + TILE_SIZE - 1) // TILE_SIZE):
+                    tile = QImage(TILE_SIZE, TILE_SIZE, QImage.Format.Format_ARGB32_Premultiplied)
+                    tile.fill(Qt.GlobalColor.transparent)
+                    painter = QPainter(tile)
+                    painter.drawImage(QPoint(-column * TILE_SIZE, -row * TILE_SIZE), image)
+                    painter.end()
+                    # пустые плитки не хранятся
+                    if tile.constBits().asstring(tile.sizeInBytes()).strip(b'\x00'):
+                        self.base_tiles[column, row] = encode_image(tile)
+        if cache:
+            # плитки уже содержат первые baked штрихов
+            for key, png in cache.items():
+                self.tiles[key] = QImage.fromData(png).convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+            self.encoded_tiles = dict(cache)
+            for stroke in self.strokes[baked:]:
+                self.paint_on_tiles(stroke.bounding_rect(), stroke.paint, create=not stroke.erase)
+        else:
+            self.render_tiles(self.base_tiles, strokes=[])
+            for stroke in self.strokes:
+                self.paint_on_tiles(stroke.bounding_rect(), stroke.paint, create=not stroke.erase)
+        self.update()
+
+    def take_layers(self, layers) -> None:
+        """Взять рисунок, разобранный в другом PaintLayers, штрихи, нарисованные до этого, рисуются поверх"""
+        strokes = self.strokes
+        self.tiles = layers.tiles
+        self.encoded_tiles = layers.encoded_tiles
+        self.base_tiles = layers.base_tiles
+        self.strokes = layers.strokes
+        self.loading = False
+        for stroke in strokes:
+            self.add_stroke(stroke)
+        self.update()
+
+    def add_stroke(self, stroke: Stroke) -> None:
+        """Нарисовать штрих поверх остальных"""
+        self.strokes.append(stroke)
+        self.paint_on_tiles(stroke.bounding_rect(), stroke.paint, create=not stroke.erase)
+
+
+class PaintCanvas(QWidget, NoteElement, PaintLayers):
+    """Холст для рисования
+    рисунок сохраняется штрихами и отображается плитками TILE_SIZE x TILE_SIZE,
+    плитки создаются только там, где есть рисунок"""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.parent = args[-1]
         self.drawing_mode = False
-        self.last_coords = None
         self.erase_mode = False
+        self.init_layers()
+        # рисуемый сейчас штрих
+        self.current_stroke = None
+        # рисунок ещё разбирается в фоновом потоке
+        self.loading = False
         
         # настройка холста
         self.setFocus()
-        pixmap = QPixmap(2000, 1000)
-        pixmap.fill(QColor('transparent'))
-        self.setPixmap(pixmap)
+        self.resize(QSize(2000, 1000))
         
         # создание и настройка кисти
         self.pen = QPen(QColor('black'), 3, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap, Qt.PenJoinStyle.RoundJoin)
 
-    def resize(self, e):
-        self.setPixmap(self.pixmap().scaled(e))
-        super().resize(e)            
+    def paintEvent(self, e):
+        # рисуются только плитки в перерисовываемой области
+        rect = e.rect()
+        painter = QPainter(self)
+        for column in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1):
+            for row in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1):
+                tile = self.tiles.get((column, row))
+                if tile is not None:
+                    painter.drawImage(QPoint(column * TILE_SIZE, row * TILE_SIZE), tile)
+        painter.end()
+
+    def finish_stroke(self) -> None:
+        """Завершить рисуемый штрих"""
+        if self.current_stroke is not None and self.current_stroke.points:
+            self.strokes.append(self.current_stroke)
+            self.parent.history.push(StrokeCommand(self, self.current_stroke))
+        self.current_stroke = None
+
+    def remove_stroke(self, stroke: Stroke) -> None:
+        """Убрать штрих, перерисовываются только задетые им плитки"""
+        if self.strokes and self.strokes[-1] is stroke:
+            self.strokes.pop()
+        else:
+            self.strokes.remove(stroke)
+        rect = stroke.bounding_rect()
+        self.render_tiles((column, row) for column in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1)
+                          for row in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1))
+        self.content_changed = True
+        self.update(rect)
 
     def mouseMoveEvent(self, e):
         # рисование
         if self.drawing_mode:
-            if self.last_coords is None:
-                self.last_coords = e.position()
-                return
-            canvas = self.pixmap()
-            painter = QPainter(canvas)
-            if not self.erase_mode:
-                painter.setPen(self.pen)
-                painter.drawLine(self.last_coords, e.position())
-            else:
-                width = self.pen.width()
-                painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear)
-                painter.eraseRect(QRect(e.position().toPoint() - QPoint(width // 2, width // 2),
-                                        QSize(width, width)))
-            painter.end()
-            self.setPixmap(canvas)
-            self.last_coords = e.position()
+            if self.current_stroke is None:
+                self.current_stroke = Stroke(self.pen.color().rgba(), self.pen.width(), self.erase_mode)
+            stroke = self.current_stroke
+            stroke.points.append(e.position())
+            # рисуется только новая точка, тем же Stroke.paint, что и при загрузке
+            start = len(stroke.points) - 1
+            if stroke.erase or start:
+                self.paint_on_tiles(stroke.bounding_rect(start), lambda painter: stroke.paint(painter, start),
+                                    create=not stroke.erase)
 
     def mouseReleaseEvent(self, e):
         if self.drawing_mode:
-            self.last_coords = None
+            self.finish_stroke()
         else:
             super().mouseReleaseEvent(e)
 
     def mousePressEvent(self, e):
         self.parent.do_layout()
-        self.raise_()
+        self.parent.raise_element(self)
 
     def contextMenuEvent(self, e):
         menu = QMenu(self)
@@ -741,6 +1689,7 @@ class PaintCanvas(QLabel):
 
     def set_drawing_mode(self, drawing_mode: bool) -> None:
         """Изменение режима рисования"""
+        self.finish_stroke()
         self.drawing_mode = drawing_mode
 
     def set_color(self, color: str):
@@ -762,29 +1711,79 @@ class PaintCanvas(QLabel):
     def disable(self):
         pass
 
-    def info(self) -> dict:
-        """Информация для сохранения"""
-        ba = QByteArray()
-        buff = QBuffer(ba)
-        buff.open(QIODevice.OpenModeFlag.WriteOnly) 
-        self.pixmap().save(buff, "PNG")
-        result = {'content': ba.data(),
-                  'size': (self.size().width(), self.size().height()),
+    def info(self, content: bool = True) -> dict:
+        """Информация для сохранения
+        content - добавить содержимое элемента, перекодируются только изменённые плитки"""
+        result = {'size': (self.size().width(), self.size().height()),
                   'coords': self.geometry().getCoords()[:3],
                   'args': str({'fone': self.parent.styleSheet(),
                                'size': str((self.parent.size().width(), self.parent.size().height()))})}
+        if content:
+            self.finish_stroke()
+            cache = {}
+            # много штрихов дольше перерисовывать при загрузке, чем читать плитки
+            baked = len(self.strokes) if len(self.strokes) >= RASTER_CACHE_STROKES else 0
+            if baked:
+                for key, tile in self.tiles.items():
+                    if key not in self.encoded_tiles:
+                        self.encoded_tiles[key] = encode_image(tile)
+                cache = self.encoded_tiles
+            result['content'] = b''.join([STROKES_SIGNATURE,
+                                          struct.pack('<IIII', len(self.base_tiles), len(cache), baked,
+                                                      len(self.strokes)),
+                                          pack_tiles(self.base_tiles), pack_tiles(cache)] +
+                                         [stroke.to_bytes() for stroke in self.strokes])
         return result
 
-    def set_content(self, content):
-        """Загрузка изображения"""
-        ba = QByteArray(content)
-        buff = QBuffer(ba)
-        buff.open(QIODevice.OpenModeFlag.WriteOnly)
-        
-        pix = QPixmap()
-        pix.loadFromData(ba)
-        self.setPixmap(pix)
-        
+
+class NoteLoaderSignals(QObject):
+    """Сигналы фоновой загрузки заметки, принимаются в главном потоке"""
+    rows_loaded = pyqtSignal(object)
+    image_decoded = pyqtSignal(int, QImage)
+    # None, если рисунок не разобрался
+    paint_decoded = pyqtSignal(object)
+
+
+class NoteLoader(QRunnable):
+    """Чтение заметки из базы данных в фоновом потоке"""
+    def __init__(self, database, note_id: int, signals: NoteLoaderSignals):
+        super().__init__()
+        self.database = database
+        self.note_id = note_id
+        self.signals = signals
+
+    def run(self):
+        self.signals.rows_loaded.emit(self.database.get_note_layout(self.note_id))
+
+
+class ImageDecoder(QRunnable):
+    """Разбор картинки в фоновом потоке"""
+    def __init__(self, data_id: int, content, signals: NoteLoaderSignals):
+        super().__init__()
+        self.data_id = data_id
+        self.content = content
+        self.signals = signals
+
+    def run(self):
+        self.signals.image_decoded.emit(self.data_id, QImage.fromData(read_content(self.content)))
+
+
+class PaintDecoder(QRunnable):
+    """Разбор рисунка холста в фоновом потоке"""
+    def __init__(self, content: bytes, signals: NoteLoaderSignals):
+        super().__init__()
+        self.content = content
+        self.signals = signals
+
+    def run(self):
+        layers = PaintLayers()
+        layers.init_layers()
+        try:
+            layers.set_content(self.content)
+        except Exception:
+            layers = None
+        self.signals.paint_decoded.emit(layers)
+
 
 class AddContentButton(QToolButton):
     """класс кнопок с возможностью добавить контент, перетащив их на холст"""
@@ -817,6 +1816,8 @@ class NoteEditor(QMainWindow):
         super().__init__(*args, **kwargs)
         self.note_id = note_id
         self.viewer = viewer
+        # сохранение отложено до конца разбора рисунка
+        self.save_pending = False
         # настройка окна
         self.setWindowTitle('Note editor')
         self.setGeometry(100, 100, 800, 600)
@@ -859,11 +1860,23 @@ class NoteEditor(QMainWindow):
         self.pen_mode_action = QAction('Ручка', self)
         self.pen_mode_action.setCheckable(True)
         self.pen_mode_action.toggled.connect(self.set_pen_mode)
+        # действия отмены и повтора
+        undo_action = QAction('Отменить', self)
+        undo_action.setShortcut(QKeySequence.StandardKey.Undo)
+        undo_action.triggered.connect(self.undo)
+        redo_action = QAction('Повторить', self)
+        redo_action.setShortcut(QKeySequence.StandardKey.Redo)
+        redo_action.triggered.connect(self.redo)
 
         # кнопка сохранения
         save_button = QToolButton(self)
         save_button.setText('Сохранить')
         save_button.clicked.connect(self.save)
+        # кнопки отмены и повтора
+        undo_button = QToolButton(self)
+        undo_button.setDefaultAction(undo_action)
+        redo_button = QToolButton(self)
+        redo_button.setDefaultAction(redo_action)
         # кнопка переключения режима рисования
         drawing_mode_button = AddContentButton(self)
         drawing_mode_button.setDragMode(False)
@@ -909,6 +1922,8 @@ class NoteEditor(QMainWindow):
         
         # добавление элементов в main_toolbar
         main_toolbar.addWidget(save_button)
+        main_toolbar.addWidget(undo_button)
+        main_toolbar.addWidget(redo_button)
         main_toolbar.addWidget(drawing_mode_button)
         main_toolbar.addWidget(create_text_button)
         main_toolbar.addWidget(create_file_button)
@@ -1006,11 +2021,13 @@ class NoteEditor(QMainWindow):
         self.paint_toolbar.addWidget(pen_mode_button)
         
         # Создание и настройка рабочей зоны ###
-        scroll_area = QScrollArea(self)
+        self.scroll_area = QScrollArea(self)
         self.canvas = Canvas(self, objectName='main')
-        scroll_area.setWidget(self.canvas)
+        self.scroll_area.setWidget(self.canvas)
+        self.scroll_area.horizontalScrollBar().valueChanged.connect(self.update_viewport)
+        self.scroll_area.verticalScrollBar().valueChanged.connect(self.update_viewport)
     
-        self.setCentralWidget(scroll_area)
+        self.setCentralWidget(self.scroll_area)
 
     def update_style(self):
         '''load style from file and apply it'''
@@ -1127,33 +2144,103 @@ class NoteEditor(QMainWindow):
             self.erase_mode_action.setChecked(False)
         self.canvas.paint_canvas.set_pen_mode(state)
 
-    def save(self):
-        """Сохранение заметки"""
-        self.viewer.database.clear_note_content(self.note_id)
-        for data in self.canvas.layout:
-            self.viewer.save_note(type=type(data).__name__, **data.info(), note_id=self.note_id)
+    def undo(self):
+        """Отмена последнего изменения холста"""
+        self.canvas.undo()
 
-    def load_note(self, note_content: list | tuple):
-        """Загрузка информации из базы данных"""
+    def redo(self):
+        """Повтор отменённого изменения холста"""
+        self.canvas.redo()
+
+    def save(self):
+        """Сохранение изменённых элементов заметки"""
+        if self.canvas.paint_canvas.loading:
+            # без разобранного рисунка сохранились бы только штрихи, нарисованные после открытия,
+            # заметка сохранится в paint_decoded
+            self.save_pending = True
+            return
+        self.save_pending = False
+        changed = []
+        records = []
+        for layer, element in enumerate(self.canvas.layout):
+            # заглушка картинки, которая ещё загружается, сохранится после загрузки
+            if element in self.canvas.fetcher.replies or not element.is_changed(layer):
+                continue
+            info = element.info(content=element.content_changed or element.data_id is None)
+            changed.append((layer, element))
+            records.append({'data_id': element.data_id, 'type': element.type_name(),
+                            'coords': str(info['coords']), 'size': str(info['size']),
+                            'content': info.get('content'), 'args': info.get('args', ''), 'layer': layer})
+        ids = self.viewer.database.save_note_changes(self.note_id, records, self.canvas.deleted_ids)
+        for (layer, element), data_id in zip(changed, ids):
+            element.data_id = data_id
+            element.set_saved(layer)
+        self.canvas.deleted_ids = []
+
+    def load_note(self, note_content: list | tuple, background: bool = False):
+        """Загрузка информации из базы данных
+        background - картинки и рисунок разбираются в фоновых потоках и показываются позже"""
+        self.canvas.decode_in_background = background
         for info in note_content:
             note_id, data_id, type, coords, content, size, args = info
             if type == 'PaintCanvas':
-                self.canvas.set_paint_canvas(content)
+                self.canvas.set_paint_canvas(None if background else content)
+                self.canvas.paint_canvas.loading = background
                 self.canvas.set_args(**eval(args))
-            elif type == 'NoteLabel':
-                note = self.canvas.add_note(QPoint(*eval(coords)), text=content.decode('utf-8'))
-                note.resize(QSize(*eval(size)))
-            elif type == 'ImageLabel':
-                image = self.canvas.add_image(QPoint(*eval(coords)), image=content)
-                image.resize(QSize(*eval(size)))
-            elif type == 'CodeLabel':
-                note = self.canvas.add_code(QPoint(*eval(coords)), text=content.decode('utf-8'))
-                note.resize(QSize(*eval(size)))
-            elif type == 'File':
-                note = self.canvas.add_file(QPoint(*eval(coords)), file='')
-                note.set_file(content)
-                note.set_args(**eval(args))
+                note = self.canvas.paint_canvas
+            elif type in ('NoteLabel', 'ImageLabel', 'CodeLabel', 'File'):
+                # виджеты создаются только для элементов в видимой области
+                note = self.canvas.add_record(type, QRect(QPoint(*eval(coords)), QSize(*eval(size))), content, args)
+            else:
+                continue
+            note.data_id = data_id
+        for layer, element in enumerate(self.canvas.layout):
+            element.set_saved(layer)
+        # загрузка заметки не отменяется
+        self.canvas.history.clear()
+        self.update_viewport()
         self.canvas.do_layout()
+
+    def load_note_in_background(self, database, note_id: int):
+        """Загрузка заметки без остановки интерфейса: сначала текст и код, затем картинки и рисунок"""
+        self.loader_signals = NoteLoaderSignals(self)
+        self.loader_signals.rows_loaded.connect(self.show_loaded_rows)
+        self.loader_signals.paint_decoded.connect(self.paint_decoded)
+        QThreadPool.globalInstance().start(NoteLoader(database, note_id, self.loader_signals))
+
+    def show_loaded_rows(self, rows: list):
+        """Показать прочитанные элементы и запустить разбор рисунка
+        картинки разбираются, только когда попадают в видимую область"""
+        self.load_note(rows, background=True)
+        for note_id, data_id, type, coords, content, size, args in rows:
+            if type == 'PaintCanvas':
+                QThreadPool.globalInstance().start(PaintDecoder(content, self.loader_signals))
+
+    def paint_decoded(self, layers):
+        """Показать разобранный в фоне рисунок и выполнить отложенное сохранение
+        layers - None, если рисунок не разобрался, тогда на холсте остаются только новые штрихи"""
+        if layers is None:
+            self.canvas.paint_canvas.loading = False
+        else:
+            self.canvas.paint_canvas.take_layers(layers)
+        if self.save_pending:
+            self.save()
+
+    def update_viewport(self, *args):
+        """Показать виджетами элементы в видимой области холста"""
+        self.canvas.update_viewport(QRect(-self.canvas.pos(), self.scroll_area.viewport().size()))
+
+    def showEvent(self, e):
+        self.update_viewport()
+        super().showEvent(e)
+
+    def closeEvent(self, e):
+        self.canvas.fetcher.cancel_all()
+        super().closeEvent(e)
+
+    def resizeEvent(self, e):
+        self.update_viewport()
+        super().resizeEvent(e)
                 
 
 def main():